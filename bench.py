@@ -0,0 +1,346 @@
+import datetime
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pygrametl.tables import FactTable
+from config import connect_source, connect_dw, read_config
+from control import WATERMARK_TABLE, CHECKPOINT_TABLE, DIMENSION_VERSION_TABLE
+from parent_class import TransformBase
+from etl import run_dimension_etl, run_fact_etl, load_dimensions, CHUNK_SIZE
+from datetime_dimension import generate_datetime_dimension, DATETIME_CREATE_SQL
+from dimensions import DIMENSION_SPECS
+from metrics import ObjectMetrics, METRICS_DIR, write_atomic
+from reporting import configure_logging, get_log_level
+from rows import ROW_MODES
+
+logger = logging.getLogger(__name__)
+
+# number of fact rows of each benchmark scale, dimensions grow with the facts
+BENCH_SCALES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+# folder of the benchmark results and of the lookup snapshots of the benchmark runs
+BENCH_DIR = os.path.join(METRICS_DIR, 'bench')
+# stored results the runs are compared with, per scale
+BENCH_BASELINE = os.path.join(os.getcwd(), 'bench_baseline.json')
+# relative change of throughput, peak rss or round trips reported as a regression
+BENCH_TOLERANCE = 0.1
+# facts cover one year of 10 minute buckets
+BENCH_START = datetime.date(2024, 1, 1)
+BENCH_END = datetime.date(2025, 1, 1)
+
+
+# function to get the number of members of each dimension of a scale
+def get_dimension_sizes(fact_rows):
+    return {'partner': max(1000, fact_rows // 20), 'employee': 997, 'location': 4999}
+
+
+# source tables shaped like the dimensions and the fact, generated in the source database, one set per scale.
+# Values are derived from the row number, so every run reads the same data.
+SOURCE_SQL = {
+    'partner': '''CREATE TABLE {table} AS SELECT g AS initial_id, 'partner ' || g AS name, 'R' || g AS ref,
+                  g % 5 = 0 AS is_company, g % 50 <> 0 AS active, g % 3 <> 0 AS customer, g % 7 = 0 AS supplier,
+                  g % 11 = 0 AS employee, (ARRAY['draft', 'open', 'done'])[g % 3 + 1] AS state, g % 100 AS seq,
+                  g % 1000 AS seq_order, g % 4999 + 1 AS street_id, 'class ' || g % 4 AS classify,
+                  (g % 100000)::numeric / 100 AS total_sh
+                  FROM generate_series(1, {rows}) AS g''',
+    'employee': '''CREATE TABLE {table} AS SELECT g AS initial_id, 'user' || g AS login, 'employee ' || g AS name,
+                   g % 20 <> 0 AS active, '09' || lpad(g::text, 8, '0') AS mobile,
+                   'user' || g || '@example.com' AS email
+                   FROM generate_series(1, {rows}) AS g''',
+    'location': '''CREATE TABLE {table} AS SELECT g AS initial_id, 'street ' || g AS street, 'ward ' || g % 500 AS ward,
+                   'district ' || g % 60 AS district, 'city ' || g % 12 AS city, 'area ' || g % 3 AS area,
+                   'VN' AS country, g % 2 = 0 AS level1flag, g % 3 = 0 AS level2flag, g % 5 = 0 AS level3flag,
+                   g % 7 = 0 AS level4flag, g % 11 = 0 AS level5flag, g % 13 = 0 AS level6flag
+                   FROM generate_series(1, {rows}) AS g''',
+    'sale': '''CREATE TABLE {table} AS SELECT g AS id, g % {partners} + 1 AS partner, g % 997 + 1 AS employee,
+               g % 4999 + 1 AS location,
+               TIMESTAMP '2024-01-01' + (g::bigint * 7919 % 31536000) * INTERVAL '1 second' AS date,
+               (g % 100000)::numeric / 100 AS amount, g % 10 + 1 AS qty
+               FROM generate_series(1, {rows}) AS g''',
+}
+
+# data warehouse tables of the benchmark
+CREATE_SQL = {
+    'dim_datetime': DATETIME_CREATE_SQL,
+    'dim_partner': '''CREATE TABLE dim_partner (partner_id integer PRIMARY KEY, lookup_partner text, initial_id integer,
+                      company_code text, name text, ref text, is_company boolean, active boolean, customer boolean,
+                      supplier boolean, employee boolean, state text, seq integer, seq_order integer,
+                      street_id integer, classify text, total_sh numeric)''',
+    'dim_employee': '''CREATE TABLE dim_employee (employee_id integer PRIMARY KEY, lookup_employee text,
+                       initial_id integer, company_code text, login text, name text, active boolean, mobile text,
+                       email text)''',
+    'dim_location': '''CREATE TABLE dim_location (location_id integer PRIMARY KEY, lookup_location text,
+                       initial_id integer, company_code text, street text, ward text, district text, city text,
+                       area text, country text, level1flag boolean, level2flag boolean, level3flag boolean,
+                       level4flag boolean, level5flag boolean, level6flag boolean)''',
+    'fact_bench_sale': '''CREATE TABLE fact_bench_sale (partner_id integer, employee_id integer, location_id integer,
+                          datetime_id integer, amount numeric(14, 2), qty integer)''',
+}
+
+
+class DimPartner(TransformBase):
+    def run_class_function(self, object_name, data_source):
+        for row in data_source:
+            self.add_config_name(row)
+            yield row
+
+
+class DimEmployee(DimPartner):
+    pass
+
+
+class DimLocation(DimPartner):
+    pass
+
+
+class FactBenchSale(TransformBase):
+    def run_class_function(self, object_name, data_source):
+        company_code = self.get_company_code()
+        for row in data_source:
+            row['lookup_partner'] = '{}_{}'.format(row['partner'], company_code)
+            row['lookup_employee'] = '{}_{}'.format(row['employee'], company_code)
+            row['lookup_location'] = '{}_{}'.format(row['location'], company_code)
+            self.round_time(row)
+            yield row
+
+
+# function to get the name of a source table of a scale
+def get_source_table(name, scale):
+    return 'bench_{}_{}'.format(name, scale)
+
+
+# function to create the missing source tables of a scale with generate_series
+def generate_sources(source_conn, scale):
+    rows = BENCH_SCALES[scale]
+    sizes = get_dimension_sizes(rows)
+    cursor = source_conn.cursor()
+    for name, sql in SOURCE_SQL.items():
+        table = get_source_table(name, scale)
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (table,))
+        if cursor.fetchone()[0]:
+            continue
+        start = time.time()
+        cursor.execute(sql.format(table=table, rows=sizes.get(name, rows), partners=sizes['partner']))
+        cursor.execute('ANALYZE {}'.format(table))
+        source_conn.commit()
+        logger.info('source table {} generated in {:.1f}s'.format(table, time.time() - start))
+        print('source table {} generated in {:.1f}s'.format(table, time.time() - start))
+    cursor.close()
+
+
+# function to get the schema the benchmark loads into, it must be a dedicated schema set in the yaml
+def get_bench_schema(company_code):
+    schema = read_config(company_code).get('DW_DB_SCHEMA')
+    if not schema or schema == 'public' or not schema.startswith('bench'):
+        raise ValueError("the benchmark drops its warehouse tables, set DW_DB_SCHEMA of {}.yaml to a dedicated "
+                         "schema whose name starts with 'bench'".format(company_code))
+    return schema
+
+
+# function to drop the warehouse tables of the benchmark and the lookup snapshots, every run starts from scratch
+def reset_warehouse(dw_conn, schema, cache_dir):
+    """Only tables of the benchmark schema are dropped, the connection search_path is that schema."""
+    cursor = dw_conn.cursor()
+    cursor.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+    for table in list(CREATE_SQL) + [WATERMARK_TABLE, CHECKPOINT_TABLE, DIMENSION_VERSION_TABLE]:
+        cursor.execute('DROP TABLE IF EXISTS {}.{} CASCADE'.format(schema, table))
+    cursor.execute(CREATE_SQL['dim_datetime'])
+    cursor.close()
+    dw_conn.commit()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+# function to get the factory of a benchmark dimension, the one used by the fact lookups
+def get_dimension_factory(dimension_name):
+    spec = DIMENSION_SPECS[dimension_name]
+    return {'name': dimension_name, 'class': spec['class'], 'key': spec['key'], 'attributes': spec['attributes'],
+            'lookupatts': spec['lookupatts']}
+
+
+# function to get the factory of the benchmark fact
+def get_fact_factory(fact_writer):
+    return {'name': 'fact_bench_sale', 'class': FactTable,
+            'keyrefs': ['partner_id', 'employee_id', 'location_id', 'datetime_id'],
+            'measures': ['amount', 'qty'], 'writer': fact_writer}
+
+
+# function run in a fresh worker process: one benchmark object, so its peak rss is its own
+def run_bench_object(company_code, scale, object_name, options):
+    source_conn, dw_conn = connect_source(company_code), connect_dw(company_code)
+    try:
+        if object_name == 'dim_datetime':
+            metrics = ObjectMetrics(company_code, object_name, 'dimension')
+            metrics.start_round_trips(source_conn, dw_conn)
+            with metrics.stage('load'):
+                rows = generate_datetime_dimension(dw_conn, BENCH_START, BENCH_END)
+            metrics.stop_round_trips(source_conn, dw_conn)
+            metrics.finish(rows)
+        elif object_name.startswith('dim_'):
+            metrics = ObjectMetrics(company_code, object_name, 'dimension')
+            run_dimension_etl(object_name, getattr(sys.modules[__name__], 'Dim{}'.format(object_name[4:].title())),
+                              get_dimension_factory(object_name),
+                              'SELECT * FROM {}'.format(get_source_table(object_name[4:], scale)),
+                              source_conn, dw_conn, CREATE_SQL[object_name], company_code=company_code,
+                              metrics=metrics, chunk_size=options['chunk_size'], pipelined=options['pipelined'],
+                              row_mode=options['row_mode'])
+        else:
+            metrics = ObjectMetrics(company_code, object_name, 'fact')
+            run_fact_etl(object_name, FactBenchSale, get_fact_factory(options['fact_writer']),
+                         'SELECT * FROM {}'.format(get_source_table('sale', scale)), source_conn, dw_conn,
+                         CREATE_SQL[object_name], load_dimensions(dw_conn, options['cache_dir']),
+                         company_code=company_code, metrics=metrics, chunk_size=options['chunk_size'],
+                         pipelined=options['pipelined'], row_mode=options['row_mode'])
+    finally:
+        source_conn.close()
+        dw_conn.close()
+    result = metrics.as_dict()
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+# function to get the commit the benchmark ran on, None outside a git checkout
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# function to run the benchmark of a scale, each object in its own process, dimensions before the fact
+def run_bench(company_code, scale, options):
+    schema = get_bench_schema(company_code)
+    source_conn = connect_source(company_code)
+    generate_sources(source_conn, scale)
+    source_conn.close()
+    dw_conn = connect_dw(company_code)
+    reset_warehouse(dw_conn, schema, options['cache_dir'])
+    dw_conn.close()
+
+    results = {'scale': scale, 'fact_rows': BENCH_SCALES[scale], 'commit': get_git_commit(),
+               'started': datetime.datetime.now().isoformat(timespec='seconds'), 'options': options, 'objects': {}}
+    for object_name in ['dim_datetime', 'dim_partner', 'dim_employee', 'dim_location', 'fact_bench_sale']:
+        logger.info('bench {} {}'.format(scale, object_name))
+        print('bench {} {}'.format(scale, object_name))
+        with ProcessPoolExecutor(max_workers=1, initializer=configure_logging,
+                                 initargs=(get_log_level(),)) as executor:
+            metrics = executor.submit(run_bench_object, company_code, scale, object_name, options).result()
+        results['objects'][object_name] = {
+            'rows': metrics['rows'],
+            'wall_seconds': metrics['wall_seconds'],
+            'rows_per_second': metrics['rows_per_second'],
+            'peak_rss_kb': metrics['peak_rss_kb'],
+            'round_trips': metrics['round_trips'],
+            'stage_seconds': metrics['stage_seconds'],
+        }
+    return results
+
+
+# function to compare the results of a run with the baseline of its scale, returns the regressions found
+def compare_baseline(results, baseline):
+    regressions = []
+    base = baseline[results['scale']]
+    print('{:<16} {:>14} {:>14} {:>12} {:>12} {:>10} {:>10}'.format(
+        'object', 'rows/s', 'base rows/s', 'rss kb', 'base rss kb', 'trips', 'base trips'))
+    for object_name, current in results['objects'].items():
+        previous = base['objects'].get(object_name)
+        if not previous:
+            continue
+        trips = sum(current['round_trips'].values())
+        base_trips = sum(previous['round_trips'].values())
+        print('{:<16} {:>14} {:>14} {:>12} {:>12} {:>10} {:>10}'.format(
+            object_name, current['rows_per_second'], previous['rows_per_second'], current['peak_rss_kb'],
+            previous['peak_rss_kb'], trips, base_trips))
+        if current['rows_per_second'] < previous['rows_per_second'] * (1 - BENCH_TOLERANCE):
+            regressions.append('{}: rows per second {} < {}'.format(object_name, current['rows_per_second'],
+                                                                    previous['rows_per_second']))
+        if current['peak_rss_kb'] > previous['peak_rss_kb'] * (1 + BENCH_TOLERANCE):
+            regressions.append('{}: peak rss {} kb > {} kb'.format(object_name, current['peak_rss_kb'],
+                                                                  previous['peak_rss_kb']))
+        if trips > base_trips * (1 + BENCH_TOLERANCE):
+            regressions.append('{}: round trips {} > {}'.format(object_name, trips, base_trips))
+    return regressions
+
+
+# function to read the stored baseline, empty when there is none
+def read_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# main
+def main(company_code, scale, baseline_path=BENCH_BASELINE, save_baseline=False, chunk_size=CHUNK_SIZE,
+         pipelined=False, row_mode='dict', fact_writer='copy'):
+    options = {'chunk_size': chunk_size, 'pipelined': pipelined, 'row_mode': row_mode, 'fact_writer': fact_writer,
+               'cache_dir': os.path.join(BENCH_DIR, 'dim_cache')}
+    baseline = read_baseline(baseline_path)
+    # a run without a baseline of its scale would compare nothing
+    if not save_baseline and scale not in baseline:
+        raise ValueError('{} has no baseline of scale {} (it covers: {}), store one with --save-baseline'.format(
+            baseline_path, scale, ', '.join(sorted(baseline)) or 'none'))
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    results = run_bench(company_code, scale, options)
+    path = os.path.join(BENCH_DIR, 'bench_{}_{}.json'.format(scale, datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    write_atomic(path, json.dumps(results, indent=2, sort_keys=True))
+    logger.info('benchmark results written to {}'.format(path))
+    print('benchmark results written to {}'.format(path))
+
+    if save_baseline:
+        baseline[scale] = results
+        write_atomic(baseline_path, json.dumps(baseline, indent=2, sort_keys=True))
+        print('baseline of scale {} saved to {}'.format(scale, baseline_path))
+        return []
+    regressions = compare_baseline(results, baseline)
+    for regression in regressions:
+        logger.warning('regression: {}'.format(regression))
+        print('regression: {}'.format(regression))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option("-c", "--configs", action="store", type="string", dest="company_yaml",
+                      help="yaml of the local source and dw databases of the benchmark, for example bench.yaml")
+
+    parser.add_option('--scale', action='store', type='choice', dest='scale', default='10k',
+                      choices=list(BENCH_SCALES), help='number of fact rows: 10k, 1m or 10m')
+
+    parser.add_option('--baseline', action='store', type='string', dest='baseline', default=BENCH_BASELINE,
+                      help='json file of the stored baseline')
+
+    parser.add_option('--save-baseline', action='store_true', dest='save_baseline', default=False,
+                      help='store the results as the baseline of the scale instead of comparing them')
+
+    parser.add_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+                      help='number of rows held in memory per chunk')
+
+    parser.add_option('--pipelined', action='store_true', dest='pipelined', default=False,
+                      help='run extract, transform and load as concurrent stages')
+
+    parser.add_option('--row-mode', action='store', type='choice', dest='row_mode', default='dict',
+                      choices=ROW_MODES, help='row representation of the transform and load')
+
+    parser.add_option('--fact-writer', action='store', type='choice', dest='fact_writer', default='copy',
+                      choices=['copy', 'ensure'], help='writer of the benchmark fact')
+
+    parser.add_option('--log-level', action='store', type='choice', dest='log_level', default='INFO',
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='level of etl_process.log')
+
+    options, args = parser.parse_args()
+    if not options.company_yaml:
+        parser.error('--configs is required')
+    configure_logging(options.log_level)
+    regressions = main(options.company_yaml.strip()[:-5], options.scale, baseline_path=options.baseline,
+                       save_baseline=options.save_baseline, chunk_size=options.chunk_size,
+                       pipelined=options.pipelined, row_mode=options.row_mode, fact_writer=options.fact_writer)
+    sys.exit(1 if regressions else 0)
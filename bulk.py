@@ -0,0 +1,315 @@
+import hashlib
+import io
+import logging
+from rows import as_dict
+
+logger = logging.getLogger(__name__)
+
+
+# function to escape one value for PostgreSQL COPY text format
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# function to stream rows (sequences of values) into a table with COPY FROM STDIN
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buffer)
+
+
+# function to create an empty temp staging table with the column types of the target
+def create_staging_table(cursor, staging, target, columns):
+    # pg_temp never resolves to a permanent table of the same name
+    cursor.execute('DROP TABLE IF EXISTS pg_temp.{}'.format(staging))
+    cursor.execute('CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA'.format(
+        staging, ', '.join(columns), target))
+
+
+# function to raise when a fact holds rows with the same keyrefs, listing a few of them
+def check_duplicate_keyrefs(cursor, name, keyrefs, sample=5):
+    cursor.execute('SELECT {}, COUNT(*) FROM {} GROUP BY {} HAVING COUNT(*) > 1 LIMIT {}'.format(
+        ', '.join(keyrefs), name, ', '.join(keyrefs), sample))
+    duplicates = cursor.fetchall()
+    if duplicates:
+        raise ValueError('{} has rows with the same keyrefs {}, for example {}. The copy writer needs them unique, '
+                         'keep one row of each with: DELETE FROM {} a USING {} b WHERE a.ctid > b.ctid AND {}'.format(
+                             name, keyrefs, ', '.join(str(row) for row in duplicates), name, name,
+                             ' AND '.join('a.{} = b.{}'.format(keyref, keyref) for keyref in keyrefs)))
+
+
+class RowFactWriter:
+    """Write facts one at a time with FactTable.ensure (lookup + insert per row).
+
+    With track_delta the inserted rows are kept until take_delta, rows already
+    in the fact are not.
+    """
+
+    def __init__(self, fact_object, track_delta=False):
+        self.fact_object = fact_object
+        self.inserted = 0
+        self.delta = [] if track_delta else None
+
+    def ensure(self, row):
+        # pygrametl and psycopg2 get a dict, compact rows are converted for the call
+        if not self.fact_object.ensure(as_dict(row)):
+            self.inserted += 1
+            if self.delta is not None:
+                self.delta.append(row)
+
+    def flush(self):
+        pass
+
+    # function to get the rows inserted since the last call
+    def take_delta(self):
+        delta, self.delta = self.delta, []
+        return delta
+
+
+class CopyFactWriter:
+    """Buffer facts, COPY them into a temp staging table and merge them into the
+    fact table with one INSERT ... ON CONFLICT DO NOTHING on the keyrefs. With
+    track_delta the inserted rows are returned by the INSERT and kept until
+    take_delta."""
+
+    def __init__(self, name, keyrefs, measures, output_conn, track_delta=False):
+        self.name = name
+        self.keyrefs = list(keyrefs)
+        self.columns = self.keyrefs + list(measures)
+        self.output_conn = output_conn
+        self.staging = 'stg_{}'.format(name)
+        self.buffer = []
+        self.inserted = 0
+        self.delta = [] if track_delta else None
+
+        cursor = self.output_conn.cursor()
+        # ON CONFLICT needs a unique index on the keyrefs, facts loaded before may hold duplicates it cannot index
+        cursor.execute("SELECT to_regclass(%s) IS NULL", ('{}_keyrefs_uidx'.format(name),))
+        if cursor.fetchone()[0]:
+            check_duplicate_keyrefs(cursor, name, self.keyrefs)
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {}_keyrefs_uidx ON {}({})'.format(
+            name, name, ', '.join(self.keyrefs)))
+        create_staging_table(cursor, self.staging, name, self.columns)
+        cursor.close()
+
+    def ensure(self, row):
+        self.buffer.append(tuple(row[column] for column in self.columns))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        cursor = self.output_conn.cursor()
+        cursor.execute('TRUNCATE {}'.format(self.staging))
+        copy_rows(cursor, self.staging, self.columns, self.buffer)
+        cursor.execute('''INSERT INTO {} ({}) SELECT {} FROM {}
+                       ON CONFLICT ({}) DO NOTHING {}'''.format(self.name, ', '.join(self.columns),
+                                                               ', '.join(self.columns), self.staging,
+                                                               ', '.join(self.keyrefs),
+                                                               '' if self.delta is None else
+                                                               'RETURNING {}'.format(', '.join(self.columns))))
+        self.inserted += cursor.rowcount
+        if self.delta is not None:
+            self.delta += [dict(zip(self.columns, values)) for values in cursor.fetchall()]
+        logger.debug('{}: merged {} rows, {} new'.format(self.name, len(self.buffer), cursor.rowcount))
+        cursor.close()
+        self.buffer = []
+
+    # function to get the rows inserted since the last call
+    def take_delta(self):
+        delta, self.delta = self.delta, []
+        return delta
+
+
+# function to compute the change-detection hash over the attributes of a dimension row
+def row_hash(row, attributes):
+    return hashlib.md5('\x1f'.join(copy_value(row[att]) for att in attributes).encode('utf8')).hexdigest()
+
+
+class MaxKeyFinder:
+    """pygrametl idfinder assigning MAX + 1 keys.
+
+    The maximum is read again by reset, after a checkpoint commit released the
+    dimension lock and another load may have added members.
+    """
+
+    def __init__(self, output_conn, name, key):
+        self.output_conn = output_conn
+        self.name = name
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        cursor = self.output_conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX({}), 0) FROM {}'.format(self.key, self.name))
+        self.last = cursor.fetchone()[0]
+        cursor.close()
+
+    def __call__(self, row, namemapping={}):
+        self.last += 1
+        return self.last
+
+
+class WriteCounter:
+    """pygrametl ConnectionWrapper proxy counting the INSERT and UPDATE statements run through it."""
+
+    def __init__(self, connection_wrapper):
+        self.connection_wrapper = connection_wrapper
+        self.writes = 0
+
+    def execute(self, stmt, arguments=None, namemapping=None, translate=True):
+        if stmt.lstrip()[:6].upper() in ('INSERT', 'UPDATE'):
+            self.writes += 1
+        return self.connection_wrapper.execute(stmt, arguments, namemapping, translate)
+
+    def __getattr__(self, name):
+        return getattr(self.connection_wrapper, name)
+
+
+class RowDimensionWriter:
+    """Write dimension members one at a time with scdensure.
+
+    scdensure does not report whether it wrote, so the members it inserted or
+    updated are counted on the WriteCounter the dimension object writes through.
+    """
+
+    def __init__(self, dimension_object, key_finder=None, write_counter=None):
+        self.dimension_object = dimension_object
+        self.key_finder = key_finder
+        self.write_counter = write_counter
+        self.changed = 0
+
+    def ensure(self, row):
+        if self.write_counter is None:
+            self.dimension_object.scdensure(as_dict(row))
+            self.changed += 1
+            return
+        writes = self.write_counter.writes
+        self.dimension_object.scdensure(as_dict(row))
+        if self.write_counter.writes > writes:
+            self.changed += 1
+
+    def flush(self):
+        pass
+
+    # called after a checkpoint commit, once the dimension lock is taken again
+    def checkpoint(self):
+        if self.key_finder:
+            self.key_finder.reset()
+
+
+class SetDimensionSync:
+    """Type-1 dimension sync with set-based statements.
+
+    Each chunk is COPYed into a temp staging table together with a hash of its
+    attributes. One UPDATE rewrites the members whose hash differs and one
+    INSERT adds the members whose lookupatts are new.
+    """
+
+    hash_column = 'row_hash'
+
+    def __init__(self, name, key, attributes, lookupatts, output_conn):
+        self.name = name
+        self.key = key
+        self.attributes = list(attributes)
+        self.lookupatts = list(lookupatts)
+        self.columns = self.attributes + [self.hash_column]
+        self.output_conn = output_conn
+        self.staging = 'stg_{}'.format(name)
+        self.buffer = []
+        self.updated = 0
+        self.inserted = 0
+
+        cursor = self.output_conn.cursor()
+        cursor.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} char(32)'.format(name, self.hash_column))
+        create_staging_table(cursor, self.staging, name, self.columns)
+        cursor.close()
+
+    @property
+    def changed(self):
+        return self.updated + self.inserted
+
+    def ensure(self, row):
+        self.buffer.append(tuple(row[att] for att in self.attributes) + (row_hash(row, self.attributes),))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        lookups = ', '.join(self.lookupatts)
+        # keep the last staged row of each member, like consecutive scdensure calls would
+        latest = 'SELECT DISTINCT ON ({}) * FROM {} ORDER BY {}, ctid DESC'.format(lookups, self.staging, lookups)
+        join = ' AND '.join('d.{} = s.{}'.format(att, att) for att in self.lookupatts)
+
+        cursor = self.output_conn.cursor()
+        cursor.execute('TRUNCATE {}'.format(self.staging))
+        copy_rows(cursor, self.staging, self.columns, self.buffer)
+        cursor.execute('''UPDATE {} d SET {} FROM ({}) s
+                       WHERE {} AND d.{} IS DISTINCT FROM s.{}'''.format(
+            self.name, ', '.join('{} = s.{}'.format(column, column) for column in self.columns),
+            latest, join, self.hash_column, self.hash_column))
+        self.updated += cursor.rowcount
+        cursor.execute('''INSERT INTO {} ({}, {})
+                       SELECT (SELECT COALESCE(MAX({}), 0) FROM {}) + row_number() OVER (), {} FROM ({}) s
+                       WHERE NOT EXISTS (SELECT 1 FROM {} d WHERE {})'''.format(
+            self.name, self.key, ', '.join(self.columns),
+            self.key, self.name, ', '.join('s.{}'.format(column) for column in self.columns), latest,
+            self.name, join))
+        self.inserted += cursor.rowcount
+        logger.debug('{}: staged {} rows, {} updated, {} inserted'.format(
+            self.name, len(self.buffer), self.updated, self.inserted))
+        cursor.close()
+        self.buffer = []
+
+    # keys are assigned from MAX in each flush, nothing to refresh after a checkpoint
+    def checkpoint(self):
+        pass
+
+
+# function to create the dimension writer selected by the 'sync' key of the dimension factory
+def create_dimension_writer(pygram_dimension_factory, output_conn, dw_conn_wrapper):
+    sync = pygram_dimension_factory.get('sync', 'row')
+    if sync == 'set':
+        return SetDimensionSync(name=pygram_dimension_factory["name"],
+                                key=pygram_dimension_factory["key"],
+                                attributes=pygram_dimension_factory["attributes"],
+                                lookupatts=pygram_dimension_factory["lookupatts"],
+                                output_conn=output_conn)
+    if sync == 'row':
+        pygram_dim_class = pygram_dimension_factory["class"]
+        key_finder = MaxKeyFinder(output_conn, pygram_dimension_factory["name"], pygram_dimension_factory["key"])
+        write_counter = WriteCounter(dw_conn_wrapper)
+        pygram_dim_object = pygram_dim_class(
+            name=pygram_dimension_factory["name"],
+            key=pygram_dimension_factory["key"],
+            attributes=pygram_dimension_factory["attributes"],
+            lookupatts=pygram_dimension_factory["lookupatts"],
+            targetconnection=write_counter,
+            cachesize=0,
+            prefill=True,
+            idfinder=key_finder)
+        return RowDimensionWriter(pygram_dim_object, key_finder, write_counter)
+    raise ValueError('unknown dimension sync {} for {}'.format(sync, pygram_dimension_factory["name"]))
+
+
+# function to create the fact writer selected by the 'writer' key of the fact factory
+def create_fact_writer(pygram_fact_factory, output_conn, dw_conn_wrapper, track_delta=False):
+    writer = pygram_fact_factory.get('writer', 'ensure')
+    if writer == 'copy':
+        return CopyFactWriter(name=pygram_fact_factory["name"],
+                              keyrefs=pygram_fact_factory["keyrefs"],
+                              measures=pygram_fact_factory["measures"],
+                              output_conn=output_conn,
+                              track_delta=track_delta)
+    if writer == 'ensure':
+        pygram_fact_class = pygram_fact_factory["class"]
+        pygram_fact_object = pygram_fact_class(
+            name=pygram_fact_factory["name"],
+            measures=pygram_fact_factory["measures"],
+            keyrefs=pygram_fact_factory["keyrefs"],
+            targetconnection=dw_conn_wrapper)
+        return RowFactWriter(pygram_fact_object, track_delta)
+    raise ValueError('unknown fact writer {} for {}'.format(writer, pygram_fact_factory["name"]))
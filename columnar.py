@@ -0,0 +1,151 @@
+import copy
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH_START = datetime.datetime(1970, 1, 1)
+
+
+# function to make sure numpy is available before the batch api is used
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for batch transforms, install it or remove batch_steps')
+
+
+class ColumnBatch:
+    """Columnar view of a chunk of dict rows.
+
+    A column is converted to a NumPy array the first time it is read, columns
+    that are set are written back into the rows by write_back.
+    """
+
+    def __init__(self, rows):
+        require_numpy()
+        self.rows = rows
+        self.columns = {}
+        self.new_columns = []
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.array([row[name] for row in self.rows], dtype=object)
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        self.columns[name] = values
+        if name not in self.new_columns:
+            self.new_columns.append(name)
+
+    def write_back(self):
+        for name in self.new_columns:
+            values = self.columns[name]
+            # tolist gives python int and str, the same types as the per-row helpers
+            values = values.tolist() if hasattr(values, 'tolist') else list(values)
+            for row, value in zip(self.rows, values):
+                row[name] = value
+
+
+# function to convert local wall-clock seconds to epochs, the local offset is computed once per distinct minute
+def local_to_epoch(wall_seconds):
+    minutes, inverse = np.unique(wall_seconds // 60, return_inverse=True)
+    offsets = np.array([minute * 60 - int((EPOCH_START + datetime.timedelta(seconds=int(minute * 60))).timestamp())
+                        for minute in minutes], dtype=np.int64)
+    return wall_seconds - offsets[inverse]
+
+
+# function to get wall-clock seconds and microseconds of naive datetimes, None when the column needs the per-row path
+def wall_seconds(values, unit='s'):
+    present = [value for value in values if value is not None]
+    if any(getattr(value, 'tzinfo', None) is not None for value in present):
+        return None, None, None
+    mask = np.array([value is None for value in values])
+    if unit == 'D':
+        filled = np.array([EPOCH_START if value is None else value for value in values], dtype='datetime64[D]')
+        return filled.astype(np.int64) * 86400, np.zeros(len(values), dtype=np.int64), mask
+    filled = np.array([EPOCH_START if value is None else value for value in values], dtype='datetime64[us]')
+    micros = filled.astype(np.int64)
+    # floor division, the microseconds are kept to truncate the epoch like int(dt.timestamp())
+    return micros // 1000000, micros % 1000000, mask
+
+
+# function to truncate epochs toward zero like int(dt.timestamp()), which rounds up a negative epoch with microseconds
+def truncate_epoch(epochs, micros):
+    return epochs + ((epochs < 0) & (micros > 0))
+
+
+# function to round one datetime down to its bucket, like TransformBase.round_time
+def round_datetime(dt, step=600):
+    seconds = (dt - dt.min).seconds
+    return dt + datetime.timedelta(0, seconds // step * step - seconds)
+
+
+# function to apply a per-row datetime conversion when the column cannot be vectorized
+def per_row(values, function):
+    return np.array([None if value is None else function(value) for value in values], dtype=object)
+
+
+# function to mask missing values of an epoch array
+def with_missing(epochs, mask):
+    if not mask.any():
+        return epochs
+    result = epochs.astype(object)
+    result[mask] = None
+    return result
+
+
+# vectorized TransformBase.round_time: epoch of the 10 minute bucket of each datetime
+def round_time(dates, step=600):
+    wall, micros, mask = wall_seconds(dates)
+    if wall is None:
+        return per_row(dates, lambda dt: int(round_datetime(dt, step).timestamp()))
+    # round_datetime keeps the microseconds of the datetime
+    return with_missing(truncate_epoch(local_to_epoch(wall // step * step), micros), mask)
+
+
+# vectorized TransformBase.datetime_to_epoch
+def datetime_to_epoch(dates):
+    wall, micros, mask = wall_seconds(dates)
+    if wall is None:
+        return per_row(dates, lambda dt: int(dt.timestamp()))
+    return with_missing(truncate_epoch(local_to_epoch(wall), micros), mask)
+
+
+# vectorized TransformBase.date_to_epoch: epoch of local midnight of each date
+def date_to_epoch(dates):
+    wall, _, mask = wall_seconds(dates, unit='D')
+    if wall is None:
+        return per_row(dates, lambda dt: int(datetime.datetime(dt.year, dt.month, dt.day).timestamp()))
+    return with_missing(local_to_epoch(wall), mask)
+
+
+# vectorized TransformBase.add_month_and_year: period names like 03/2021 are parsed once per distinct value
+def period_year_and_month(period_names):
+    names, inverse = np.unique(np.array([name or '' for name in period_names], dtype=object), return_inverse=True)
+    years = np.array([int(name[-4:]) if name else None for name in names], dtype=object)
+    months = np.array([int(name[:-5]) if name else None for name in names], dtype=object)
+    return years[inverse], months[inverse]
+
+
+# batch lookup key of TransformBase.add_config_name: initial_id + '_' + company code
+# the keys stay python str, numpy fixed-width strings drop trailing NUL characters
+def lookup_keys(initial_ids, company_code):
+    if company_code is None:
+        # the per-row helper fails concatenating None as well
+        raise TypeError('no company code to build the lookup keys, set SRC_COMPANY_CODE')
+    if any(value is None for value in initial_ids):
+        raise ValueError('initial_id is NULL, no lookup key can be built')
+    suffix = '_' + company_code
+    return np.array([str(value) + suffix for value in initial_ids], dtype=object)
+
+
+# function to compare the batch api of a transform with its per-row helpers, returns the rows that differ
+def batch_parity(transform, rows):
+    per_row_rows = copy.deepcopy(rows)
+    batch_rows = copy.deepcopy(rows)
+    for row in per_row_rows:
+        for step in transform.batch_steps:
+            getattr(transform, step)(row)
+    transform.apply_batch(batch_rows)
+    return [(expected, actual) for expected, actual in zip(per_row_rows, batch_rows) if expected != actual]
@@ -0,0 +1,58 @@
+import yaml
+import psycopg2
+from metrics import CountingConnection
+
+
+# function to read the yaml config of a company
+def read_config(company_code):
+    with open('{}.yaml'.format(company_code), 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+# function to build a connection string from the config, prefix is SRC or DW
+# an optional <prefix>_DB_SCHEMA becomes the search_path of every connection
+def get_connection_string(data_loaded, prefix):
+    connection_string = """host='{}' port = '{}' dbname='{}' user='{}' password='{}'""".format(
+        data_loaded['{}_DB_HOST'.format(prefix)],
+        data_loaded['{}_DB_PORT'.format(prefix)],
+        data_loaded['{}_DB_NAME'.format(prefix)],
+        data_loaded['{}_DB_USER'.format(prefix)],
+        data_loaded['{}_DB_PASSWORD'.format(prefix)])
+    schema = data_loaded.get('{}_DB_SCHEMA'.format(prefix))
+    if schema:
+        connection_string += """ options='-c search_path={}'""".format(schema)
+    return connection_string
+
+
+# function to open a connection that counts its round trips, reported in the run metrics
+def connect(connection_string):
+    return psycopg2.connect(connection_string, connection_factory=CountingConnection)
+
+
+# function to create a new connection to the source database of a company
+def connect_source(company_code):
+    return connect(get_connection_string(read_config(company_code), 'SRC'))
+
+
+# function to create a new connection to the data warehouse of a company
+def connect_dw(company_code):
+    return connect(get_connection_string(read_config(company_code), 'DW'))
+
+
+# function to get the data warehouse a company loads into, companies with the same target share it
+# companies of one database in different DW_DB_SCHEMA are different targets
+def get_dw_target(company_code):
+    data_loaded = read_config(company_code)
+    return (data_loaded['DW_DB_HOST'], str(data_loaded['DW_DB_PORT']), data_loaded['DW_DB_NAME'],
+            data_loaded.get('DW_DB_SCHEMA') or '')
+
+
+# function to get config
+def get_configs(company_code):
+    data_loaded = read_config(company_code)
+    src_pgconn = connect(get_connection_string(data_loaded, 'SRC'))
+
+    # create connection to new data warehouse
+    dw_pgconn = connect(get_connection_string(data_loaded, 'DW'))
+
+    return src_pgconn, dw_pgconn
@@ -0,0 +1 @@
+# the modules of the etl live at the repository root, tests import them from there
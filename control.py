@@ -0,0 +1,262 @@
+import json
+import logging
+import time
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+# control table holding the high-water mark of each object per company
+WATERMARK_TABLE = 'etl_watermark'
+
+
+# function to lock an object until the end of the transaction, so concurrent runs do not race on its keys
+def lock_object(output_conn, object_name):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (object_name,))
+    cursor.close()
+
+
+# function to create the watermark control table if not exist
+def ensure_watermark_table(output_conn):
+    cursor = output_conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                      company_code varchar NOT NULL,
+                      object_name varchar NOT NULL,
+                      watermark text,
+                      updated_at timestamp NOT NULL DEFAULT now(),
+                      PRIMARY KEY (company_code, object_name))'''.format(WATERMARK_TABLE))
+    cursor.close()
+
+
+# function to get the stored watermark of an object, None when never loaded
+def get_watermark(output_conn, company_code, object_name):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT watermark FROM {} WHERE company_code = %s AND object_name = %s'.format(WATERMARK_TABLE),
+                   (company_code, object_name))
+    result = cursor.fetchone()
+    cursor.close()
+    return result[0] if result else None
+
+
+# function to store the watermark of an object
+def set_watermark(output_conn, company_code, object_name, watermark):
+    cursor = output_conn.cursor()
+    cursor.execute('''INSERT INTO {} (company_code, object_name, watermark, updated_at)
+                      VALUES (%s, %s, %s, now())
+                      ON CONFLICT (company_code, object_name)
+                      DO UPDATE SET watermark = EXCLUDED.watermark, updated_at = EXCLUDED.updated_at'''.format(
+        WATERMARK_TABLE), (company_code, object_name, str(watermark)))
+    cursor.close()
+    logger.info('watermark of {} for {} advanced to {}'.format(object_name, company_code, watermark))
+
+
+# function to replace the {watermark} placeholder of a source query by an incremental predicate
+def render_watermark(source_conn, source_sql, watermark_column, watermark):
+    if '{watermark}' not in source_sql:
+        return source_sql
+    if not watermark_column or watermark is None:
+        predicate = 'TRUE'
+    else:
+        cursor = source_conn.cursor()
+        predicate = cursor.mogrify('{} > %(watermark)s'.format(watermark_column),
+                                   {'watermark': watermark}).decode('utf8')
+        cursor.close()
+    return source_sql.replace('{watermark}', predicate)
+
+
+class WatermarkTracker:
+    """Keep the highest value of a source field seen while rows stream through."""
+
+    def __init__(self, field):
+        self.field = field
+        self.value = None
+
+    def track(self, rows):
+        for row in rows:
+            value = row.get(self.field)
+            if value is not None and (self.value is None or value > self.value):
+                self.value = value
+            yield row
+
+
+# control table holding a version counter per dimension, bumped when a load changes it
+DIMENSION_VERSION_TABLE = 'etl_dimension_version'
+
+
+# function to create the dimension version control table if not exist
+def ensure_dimension_version_table(output_conn):
+    cursor = output_conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                      dimension_name varchar PRIMARY KEY,
+                      version bigint NOT NULL,
+                      updated_at timestamp NOT NULL DEFAULT now())'''.format(DIMENSION_VERSION_TABLE))
+    cursor.close()
+
+
+# function to get the current version of a dimension, 0 when never changed
+def get_dimension_version(output_conn, dimension_name):
+    ensure_dimension_version_table(output_conn)
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT version FROM {} WHERE dimension_name = %s'.format(DIMENSION_VERSION_TABLE),
+                   (dimension_name,))
+    result = cursor.fetchone()
+    cursor.close()
+    return result[0] if result else 0
+
+
+# function to bump the version of a dimension, committed together with the load that changed it
+def bump_dimension_version(output_conn, dimension_name):
+    ensure_dimension_version_table(output_conn)
+    cursor = output_conn.cursor()
+    cursor.execute('''INSERT INTO {} (dimension_name, version, updated_at) VALUES (%s, 1, now())
+                      ON CONFLICT (dimension_name)
+                      DO UPDATE SET version = {}.version + 1, updated_at = EXCLUDED.updated_at'''.format(
+        DIMENSION_VERSION_TABLE, DIMENSION_VERSION_TABLE), (dimension_name,))
+    cursor.close()
+
+
+# control table holding the fact rows whose keyrefs could not be resolved
+QUARANTINE_TABLE = 'etl_quarantine'
+
+
+# function to create the quarantine control table if not exist
+def ensure_quarantine_table(output_conn):
+    cursor = output_conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                      quarantine_id bigserial PRIMARY KEY,
+                      company_code varchar NOT NULL,
+                      object_name varchar NOT NULL,
+                      reason text NOT NULL,
+                      row_data jsonb NOT NULL,
+                      created_at timestamp NOT NULL DEFAULT now())'''.format(QUARANTINE_TABLE))
+    cursor.execute('CREATE INDEX IF NOT EXISTS {}_object_idx ON {} (company_code, object_name)'.format(
+        QUARANTINE_TABLE, QUARANTINE_TABLE))
+    cursor.close()
+
+
+# function to store rows in quarantine, rows is a list of (reason, row) committed with the load
+def quarantine_rows(output_conn, company_code, object_name, rows):
+    cursor = output_conn.cursor()
+    execute_values(cursor, 'INSERT INTO {} (company_code, object_name, reason, row_data) VALUES %s'.format(
+        QUARANTINE_TABLE), [(company_code, object_name, reason, json.dumps(row, default=str)) for reason, row in rows])
+    cursor.close()
+
+
+# function to take the quarantined rows of an object out of quarantine, a rollback puts them back
+def take_quarantined_rows(output_conn, company_code, object_name):
+    ensure_quarantine_table(output_conn)
+    cursor = output_conn.cursor()
+    cursor.execute('''DELETE FROM {} WHERE company_code = %s AND object_name = %s
+                      RETURNING quarantine_id, row_data'''.format(QUARANTINE_TABLE), (company_code, object_name))
+    rows = [row_data for quarantine_id, row_data in sorted(cursor.fetchall(), key=lambda r: r[0])]
+    cursor.close()
+    return rows
+
+
+# control table holding the last source key committed by an interrupted load
+CHECKPOINT_TABLE = 'etl_checkpoint'
+
+
+# function to create the checkpoint control table if not exist
+def ensure_checkpoint_table(output_conn):
+    cursor = output_conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                      company_code varchar NOT NULL,
+                      object_name varchar NOT NULL,
+                      checkpoint text NOT NULL,
+                      rows bigint NOT NULL,
+                      updated_at timestamp NOT NULL DEFAULT now(),
+                      PRIMARY KEY (company_code, object_name))'''.format(CHECKPOINT_TABLE))
+    cursor.close()
+
+
+# function to get the last checkpoint of an object as (checkpoint, rows), None when it has none
+def get_checkpoint(output_conn, company_code, object_name):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT checkpoint, rows FROM {} WHERE company_code = %s AND object_name = %s'.format(
+        CHECKPOINT_TABLE), (company_code, object_name))
+    result = cursor.fetchone()
+    cursor.close()
+    return result
+
+
+# function to store the checkpoint of an object, committed together with the rows it covers
+def set_checkpoint(output_conn, company_code, object_name, checkpoint, rows):
+    cursor = output_conn.cursor()
+    cursor.execute('''INSERT INTO {} (company_code, object_name, checkpoint, rows, updated_at)
+                      VALUES (%s, %s, %s, %s, now())
+                      ON CONFLICT (company_code, object_name)
+                      DO UPDATE SET checkpoint = EXCLUDED.checkpoint, rows = EXCLUDED.rows,
+                                    updated_at = EXCLUDED.updated_at'''.format(CHECKPOINT_TABLE),
+                   (company_code, object_name, str(checkpoint), rows))
+    cursor.close()
+
+
+# function to remove the checkpoint of an object once its load is complete
+def clear_checkpoint(output_conn, company_code, object_name):
+    cursor = output_conn.cursor()
+    cursor.execute('DELETE FROM {} WHERE company_code = %s AND object_name = %s'.format(CHECKPOINT_TABLE),
+                   (company_code, object_name))
+    cursor.close()
+
+
+# function to order a source query by its checkpoint key, starting after the checkpoint when resuming
+def render_checkpoint(source_conn, source_sql, checkpoint_key, checkpoint):
+    predicate = 'TRUE'
+    if checkpoint is not None:
+        cursor = source_conn.cursor()
+        predicate = cursor.mogrify('{} > %(checkpoint)s'.format(checkpoint_key),
+                                   {'checkpoint': checkpoint}).decode('utf8')
+        cursor.close()
+    return 'SELECT * FROM ({}) AS checkpoint_source WHERE {} ORDER BY {}'.format(
+        source_sql.strip().rstrip(';'), predicate, checkpoint_key)
+
+
+class Checkpoint:
+    """Decide when a load commits a checkpoint and record its last source key.
+
+    A checkpoint is due every `rows` loaded rows or every `seconds`, 0 turns
+    either off. It is only taken between chunks, once they are flushed, and
+    only where the key changes: resume reads rows with a greater key, so rows
+    sharing the last key with the next chunk would be lost.
+    """
+
+    def __init__(self, output_conn, company_code, object_name, field, rows=0, seconds=0, resumed_rows=0):
+        self.output_conn = output_conn
+        self.company_code = company_code
+        self.object_name = object_name
+        self.field = field
+        self.rows = rows
+        self.seconds = seconds
+        # rows committed by the runs this one resumes
+        self.resumed_rows = resumed_rows
+        self.last_count = 0
+        self.last_time = time.time()
+        self.taken = 0
+
+    def due(self, count):
+        return bool((self.rows and count - self.last_count >= self.rows) or
+                    (self.seconds and time.time() - self.last_time >= self.seconds))
+
+    def get_key(self, row):
+        if self.field not in row:
+            raise ValueError('checkpoint key {} is not a field of the transformed rows of {}'.format(
+                self.field, self.object_name))
+        return row[self.field]
+
+    # function to tell whether the key changes between the last loaded row and the next one
+    def boundary(self, last_row, next_row):
+        return self.get_key(last_row) != self.get_key(next_row)
+
+    # function to record the checkpoint in the load transaction, the caller commits it
+    def save(self, last_row, count):
+        set_checkpoint(self.output_conn, self.company_code, self.object_name, self.get_key(last_row),
+                       self.resumed_rows + count)
+        self.last_count = count
+        self.last_time = time.time()
+        self.taken += 1
+        logger.info('checkpoint of {} at {} = {} after {} rows'.format(self.object_name, self.field,
+                                                                       last_row[self.field], count))
+
+    def clear(self):
+        clear_checkpoint(self.output_conn, self.company_code, self.object_name)
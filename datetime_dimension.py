@@ -0,0 +1,145 @@
+import datetime
+import logging
+from bulk import copy_rows, create_staging_table
+from control import bump_dimension_version
+from ddl import ensure_table
+
+logger = logging.getLogger(__name__)
+
+# dim_datetime is a regular grid of 10 minute buckets, as produced by TransformBase.round_time
+DATETIME_STEP = 600
+# first bucket of the grid (local time, like round_time and date_to_epoch), its datetime_id is 1
+DATETIME_BASE_EPOCH = int(datetime.datetime(2000, 1, 1).timestamp())
+
+DATETIME_ATTRIBUTES = ['epoch', 'minute', 'minute_20', 'minute_30', 'hour', 'day_of_week', 'day_of_month',
+                       'week', 'month', 'year', 'period']
+# create_sql of dim_datetime when the dw object folder does not provide one
+DATETIME_CREATE_SQL = '''CREATE TABLE dim_datetime (datetime_id integer PRIMARY KEY, epoch bigint, minute integer,
+                         minute_20 integer, minute_30 integer, hour integer, day_of_week integer,
+                         day_of_month integer, week integer, month integer, year integer, period text)'''
+# existing members compared with datetime_member before new ones are generated
+DATETIME_CHECK_SAMPLE = 1000
+
+
+# function to compute the datetime_id of an epoch on the grid, None when it is not a bucket
+def datetime_key(epoch):
+    offset = epoch - DATETIME_BASE_EPOCH
+    if offset < 0 or offset % DATETIME_STEP:
+        return None
+    return offset // DATETIME_STEP + 1
+
+
+# function to build the dim_datetime member of an epoch
+def datetime_member(epoch):
+    dt = datetime.datetime.fromtimestamp(epoch)
+    return {
+        'datetime_id': datetime_key(epoch),
+        'epoch': epoch,
+        'minute': dt.minute,
+        'minute_20': dt.minute // 20 * 20,
+        'minute_30': dt.minute // 30 * 30,
+        'hour': dt.hour,
+        'day_of_week': dt.isoweekday(),
+        'day_of_month': dt.day,
+        'week': dt.isocalendar()[1],
+        'month': dt.month,
+        'year': dt.year,
+        'period': dt.strftime('%m/%Y'),
+    }
+
+
+# function to refuse a dim_datetime whose existing members are not on the grid or not derived like datetime_member
+def check_datetime_dimension(output_conn, sample=DATETIME_CHECK_SAMPLE):
+    """
+    Facts reference the datetime_id of the existing members, so a table whose
+    keys do not follow the grid cannot be converted in place, it has to be
+    rebuilt together with the facts. A sample of the members is compared with
+    datetime_member, so new members are derived like the ones already loaded.
+    """
+    columns = ['datetime_id'] + DATETIME_ATTRIBUTES
+    cursor = output_conn.cursor()
+    cursor.execute('''SELECT COUNT(*) FROM dim_datetime
+                      WHERE epoch < %s OR (epoch - %s) %% %s <> 0 OR datetime_id <> (epoch - %s) / %s + 1''',
+                   (DATETIME_BASE_EPOCH, DATETIME_BASE_EPOCH, DATETIME_STEP, DATETIME_BASE_EPOCH, DATETIME_STEP))
+    off_grid = cursor.fetchone()[0]
+    if off_grid:
+        cursor.close()
+        raise ValueError('dim_datetime has {} members off the {} second grid, it cannot be converted in place: '
+                         'rebuild it and reload the facts that reference it'.format(off_grid, DATETIME_STEP))
+    cursor.execute('SELECT {} FROM dim_datetime ORDER BY random() LIMIT %s'.format(', '.join(columns)), (sample,))
+    for values in cursor.fetchall():
+        stored = dict(zip(columns, values))
+        member = datetime_member(stored['epoch'])
+        differing = [column for column in DATETIME_ATTRIBUTES if member[column] != stored[column]]
+        if differing:
+            cursor.close()
+            raise ValueError('dim_datetime member {} has {} derived differently ({} instead of {})'.format(
+                stored['datetime_id'], ', '.join(differing), [stored[c] for c in differing],
+                [member[c] for c in differing]))
+    cursor.close()
+
+
+# function to populate dim_datetime for every bucket from start_date to end_date (exclusive) in one pass
+def generate_datetime_dimension(output_conn, start_date, end_date, chunk_size=50000, create_sql=DATETIME_CREATE_SQL):
+    columns = ['datetime_id'] + DATETIME_ATTRIBUTES
+    if ensure_table(output_conn, 'dim_datetime', create_sql):
+        logger.info('dim_datetime created')
+    else:
+        check_datetime_dimension(output_conn)
+    start = max(int(datetime.datetime(start_date.year, start_date.month, start_date.day).timestamp()),
+                DATETIME_BASE_EPOCH)
+    end = int(datetime.datetime(end_date.year, end_date.month, end_date.day).timestamp())
+    # first bucket of the grid at or after start
+    start += -(start - DATETIME_BASE_EPOCH) % DATETIME_STEP
+
+    cursor = output_conn.cursor()
+    create_staging_table(cursor, 'stg_dim_datetime', 'dim_datetime', columns)
+    inserted = 0
+    for chunk_start in range(start, end, DATETIME_STEP * chunk_size):
+        chunk_end = min(chunk_start + DATETIME_STEP * chunk_size, end)
+        members = [datetime_member(epoch) for epoch in range(chunk_start, chunk_end, DATETIME_STEP)]
+        cursor.execute('TRUNCATE stg_dim_datetime')
+        copy_rows(cursor, 'stg_dim_datetime', columns, [[member[c] for c in columns] for member in members])
+        cursor.execute('''INSERT INTO dim_datetime ({}) SELECT {} FROM stg_dim_datetime s
+                       WHERE NOT EXISTS (SELECT 1 FROM dim_datetime d WHERE d.datetime_id = s.datetime_id)'''.format(
+            ', '.join(columns), ', '.join(columns)))
+        inserted += cursor.rowcount
+    cursor.close()
+    if inserted:
+        bump_dimension_version(output_conn, 'dim_datetime')
+    output_conn.commit()
+    logger.info('dim_datetime generated from {} to {}, {} new members'.format(start_date, end_date, inserted))
+    print('dim_datetime generated from {} to {}, {} new members'.format(start_date, end_date, inserted))
+    return inserted
+
+
+class ComputedDatetimeDimension:
+    """dim_datetime lookup that computes datetime_id from the epoch in constant time.
+
+    The epoch range of the table is read once; epochs outside it, or not on the
+    grid, are not members and lookup returns None.
+    """
+
+    # keys are computed, fact runs cannot infer members
+    computed = True
+
+    def __init__(self, output_conn, name='dim_datetime', key='datetime_id', lookupatt='epoch'):
+        self.name = name
+        self.key = key
+        self.lookupatts = [lookupatt]
+        self.lookupatt = lookupatt
+        cursor = output_conn.cursor()
+        cursor.execute('''SELECT MIN({}), MAX({}), COUNT(*),
+                          COUNT(*) FILTER (WHERE {} <> ({} - %s) / %s + 1) FROM {}'''.format(
+            lookupatt, lookupatt, key, lookupatt, name), (DATETIME_BASE_EPOCH, DATETIME_STEP))
+        self.min_epoch, self.max_epoch, count, mismatched = cursor.fetchone()
+        cursor.close()
+        if count and (mismatched or count != (self.max_epoch - self.min_epoch) // DATETIME_STEP + 1):
+            raise ValueError('{} is not a complete computed-key grid, regenerate it with '
+                             '--generate-datetime'.format(name))
+
+    def lookup(self, row, namemapping={}):
+        epoch = row[namemapping.get(self.lookupatt, self.lookupatt)]
+        if epoch is None or self.min_epoch is None or not self.min_epoch <= epoch <= self.max_epoch:
+            return None
+        return datetime_key(epoch)
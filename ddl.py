@@ -0,0 +1,127 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from control import lock_object
+
+logger = logging.getLogger(__name__)
+
+# number of indexes built at the same time after a bulk load, each on its own connection
+INDEX_BUILD_WORKERS = 4
+# memory of each index build session
+INDEX_MAINTENANCE_WORK_MEM = '256MB'
+
+
+# function to check in the catalog if a table exists
+def table_exists(output_conn, table):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (table,))
+    result = cursor.fetchone()[0]
+    cursor.close()
+    return result
+
+
+# function to check if a table has no rows
+def table_is_empty(output_conn, table):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT NOT EXISTS (SELECT 1 FROM {})'.format(table))
+    result = cursor.fetchone()[0]
+    cursor.close()
+    return result
+
+
+# function to get the names of the indexes of a table from the catalog
+def get_index_names(output_conn, table):
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s',
+                   (table,))
+    result = set(name for name, in cursor.fetchall())
+    cursor.close()
+    return result
+
+
+# function to run create_sql only when the table does not exist yet, returns True when it was created
+def ensure_table(output_conn, table, create_sql):
+    if table_exists(output_conn, table):
+        return False
+    cursor = output_conn.cursor()
+    cursor.execute(create_sql)
+    cursor.close()
+    return True
+
+
+# function to get the index definitions of a factory
+def get_factory_indexes(pygram_factory, table, default_columns, defer=False):
+    """
+    Indexes are declared in the factory as 'indexes': [{'columns': [...]}, ...]
+    with optional 'name', 'unique', 'method' and 'defer' (default True: dropped
+    during a bulk load and rebuilt after it). Without a declaration each of
+    default_columns gets its own index, deferred when defer is set.
+    """
+    declared = pygram_factory.get('indexes')
+    if declared is None:
+        declared = [{'columns': [column], 'defer': defer} for column in default_columns]
+    indexes = []
+    for index in declared:
+        index = dict({'unique': False, 'method': 'btree', 'defer': True}, **index)
+        index.setdefault('name', '{}_{}_idx'.format(table, '_'.join(index['columns'])))
+        indexes.append(index)
+    return indexes
+
+
+# function to get the statement creating an index of a table
+def index_sql(table, index):
+    return 'CREATE {}INDEX IF NOT EXISTS {} ON {} USING {} ({})'.format(
+        'UNIQUE ' if index['unique'] else '', index['name'], table, index['method'], ', '.join(index['columns']))
+
+
+# function to create the missing indexes of a table, or drop the deferred ones before a bulk load
+def prepare_indexes(output_conn, table, indexes, bulk=False):
+    """Return the indexes to build once the load is committed."""
+    existing = get_index_names(output_conn, table)
+    deferred = []
+    cursor = output_conn.cursor()
+    for index in indexes:
+        if bulk and index['defer']:
+            if index['name'] in existing:
+                logger.info('drop index {} during the bulk load of {}'.format(index['name'], table))
+                cursor.execute('DROP INDEX IF EXISTS {}'.format(index['name']))
+            deferred.append(index)
+        elif index['name'] not in existing:
+            logger.info('create index {}'.format(index['name']))
+            cursor.execute(index_sql(table, index))
+    cursor.close()
+    return deferred
+
+
+# function to build one index on its own connection
+def build_index(connect, table, index):
+    conn = connect()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SET maintenance_work_mem = '{}'".format(INDEX_MAINTENANCE_WORK_MEM))
+        cursor.execute(index_sql(table, index))
+        cursor.close()
+    finally:
+        conn.close()
+    logger.info('index {} built'.format(index['name']))
+
+
+# function to build the deferred indexes of a table after its load, in parallel when connect is given, then ANALYZE it
+def build_indexes(output_conn, table, indexes, connect=None, workers=INDEX_BUILD_WORKERS):
+    logger.info('build {} deferred indexes of {}'.format(len(indexes), table))
+    print('build {} deferred indexes of {}'.format(len(indexes), table))
+    # held until the ANALYZE is committed, another load of the table builds the same indexes after this one
+    lock_object(output_conn, table)
+    if connect and len(indexes) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(indexes))) as executor:
+            for future in [executor.submit(build_index, connect, table, index) for index in indexes]:
+                future.result()
+    else:
+        cursor = output_conn.cursor()
+        for index in indexes:
+            cursor.execute(index_sql(table, index))
+        cursor.close()
+    cursor = output_conn.cursor()
+    cursor.execute('ANALYZE {}'.format(table))
+    cursor.close()
+    output_conn.commit()
@@ -0,0 +1,356 @@
+import array
+import collections
+import logging
+import mmap
+import os
+import glob
+import hashlib
+import struct
+import pygrametl
+from pygrametl.tables import CachedDimension, TypeOneSlowlyChangingDimension
+from control import get_dimension_version
+from datetime_dimension import ComputedDatetimeDimension
+
+logger = logging.getLogger(__name__)
+
+# folder of the lookup snapshots, one file per dimension and version
+DIMENSION_CACHE_DIR = os.path.join(os.getcwd(), '.dim_cache')
+
+# number of members kept by a batched dimension
+BATCHED_CACHE_SIZE = 100000
+
+# dimensions referenced by fact keyrefs
+DIMENSION_SPECS = {
+    'dim_datetime': {
+        'class': CachedDimension,
+        'key': 'datetime_id',
+        'attributes': ['epoch',
+                       'minute',
+                       'minute_20',
+                       'minute_30',
+                       'hour',
+                       'day_of_week',
+                       'day_of_month',
+                       'week',
+                       'month',
+                       'year',
+                       'period'
+                       ],
+        'lookupatts': ['epoch'],
+        # regular 10 minute grid, datetime_id is computed from the epoch
+        'lookup': 'computed',
+    },
+    'dim_location': {
+        'class': TypeOneSlowlyChangingDimension,
+        'key': 'location_id',
+        'attributes': ['lookup_location',
+                       'initial_id',
+                       'company_code',
+                       'street',
+                       'ward',
+                       'district',
+                       'city',
+                       'area',
+                       'country',
+                       'level1flag',
+                       'level2flag',
+                       'level3flag',
+                       'level4flag',
+                       'level5flag',
+                       'level6flag',
+                       ],
+        'lookupatts': ['lookup_location'],
+    },
+    'dim_employee': {
+        'class': TypeOneSlowlyChangingDimension,
+        'key': 'employee_id',
+        'attributes': ['lookup_employee', 'initial_id', 'company_code', 'login', 'name', 'active', 'mobile', 'email'],
+        'lookupatts': ['lookup_employee'],
+    },
+    'dim_partner': {
+        'class': TypeOneSlowlyChangingDimension,
+        'key': 'partner_id',
+        'attributes': ['lookup_partner', 'initial_id', 'company_code', 'name', 'ref', 'is_company', 'active',
+                       'customer',
+                       'supplier',
+                       'employee', 'state', 'seq',
+                       'seq_order',
+                       'street_id', 'classify', 'total_sh'],
+        'lookupatts': ['lookup_partner'],
+        # too large to prefill, resolved per chunk of fact rows
+        'lookup': 'batched',
+    },
+    'dim_company': {
+        'class': TypeOneSlowlyChangingDimension,
+        'key': 'company_id',
+        'attributes': ['company_code', 'company_name'],
+        'lookupatts': ['company_code'],
+    },
+}
+
+# header of a snapshot file: magic, number of members, length of the data block
+SNAPSHOT_MAGIC = b'DWLKSNP1'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+
+
+# function to get the folder of the snapshots of one data warehouse, DWs at the same version never share a file
+# the schema the connection resolves tables in is part of the identity, DWs can share a database
+def get_dw_cache_dir(cache_dir, output_conn):
+    parameters = output_conn.get_dsn_parameters()
+    cursor = output_conn.cursor()
+    cursor.execute('SELECT current_schema()')
+    schema = cursor.fetchone()[0] or ''
+    cursor.close()
+    identity = '{}:{}/{}/{}'.format(parameters.get('host', ''), parameters.get('port', ''),
+                                    parameters.get('dbname', ''), schema)
+    return os.path.join(cache_dir, hashlib.md5(identity.encode('utf8')).hexdigest()[:16])
+
+
+# function to get the snapshot path of a dimension version
+def get_snapshot_path(cache_dir, dimension_name, version):
+    return os.path.join(cache_dir, '{}.{}.snap'.format(dimension_name, version))
+
+
+# function to write the lookup map (lookup value -> surrogate key) of a dimension into a snapshot file
+def write_snapshot(output_conn, dimension_name, key, lookupatt, path):
+    """
+    The file holds the members sorted by lookup value as 'value\\tkey' records,
+    followed by the offsets of the records, so it can be binary searched
+    through mmap without loading it.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    offsets = array.array('Q')
+    cursor = output_conn.cursor('{}_snapshot'.format(dimension_name))
+    cursor.itersize = 10000
+    # COLLATE "C" sorts by bytes, the order used by the binary search
+    cursor.execute('SELECT {}::text, {} FROM {} WHERE {} IS NOT NULL ORDER BY 1 COLLATE "C"'.format(
+        lookupatt, key, dimension_name, lookupatt))
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 0, 0))
+        position = 0
+        for value, keyvalue in cursor:
+            record = '{}\t{}'.format(value, keyvalue).encode('utf8')
+            offsets.append(position)
+            f.write(record)
+            position += len(record)
+        offsets.append(position)
+        f.write(offsets.tobytes())
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(offsets) - 1, position))
+    cursor.close()
+    # readers only ever map a complete file, concurrent writers of the same version replace it atomically
+    os.replace(tmp_path, path)
+    logger.info('snapshot of {} written with {} members'.format(dimension_name, len(offsets) - 1))
+
+
+class SnapshotDimension:
+    """Read-only dimension lookup over a memory-mapped snapshot file.
+
+    Like a prefilled cache, a value missing from the snapshot is not a member
+    and lookup returns None.
+    """
+
+    def __init__(self, name, key, lookupatt, path):
+        self.name = name
+        self.key = key
+        self.lookupatts = [lookupatt]
+        self.lookupatt = lookupatt
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, data_len = SNAPSHOT_HEADER.unpack_from(self.map, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a dimension snapshot'.format(path))
+        self.data_start = SNAPSHOT_HEADER.size
+        self.offsets = memoryview(self.map)[self.data_start + data_len:].cast('Q')
+        # values already resolved by this run
+        self.resolved = {}
+        self.lookups = 0
+        self.searches = 0
+
+    def stats(self):
+        return {'hits': self.lookups - self.searches, 'misses': self.searches, 'evictions': 0,
+                'size': len(self.resolved)}
+
+    def get_record(self, index):
+        return self.map[self.data_start + self.offsets[index]:self.data_start + self.offsets[index + 1]]
+
+    def find(self, value):
+        prefix = value + b'\t'
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_record(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count:
+            record = self.get_record(low)
+            if record.startswith(prefix):
+                return int(record[len(prefix):])
+        return None
+
+    # function to record a member added after the snapshot was written
+    def remember(self, row, keyvalue):
+        self.resolved[row[self.lookupatt]] = keyvalue
+
+    def lookup(self, row, namemapping={}):
+        value = row[namemapping.get(self.lookupatt, self.lookupatt)]
+        if value is None:
+            return None
+        self.lookups += 1
+        try:
+            return self.resolved[value]
+        except KeyError:
+            self.searches += 1
+            keyvalue = self.resolved[value] = self.find(str(value).encode('utf8'))
+            return keyvalue
+
+
+class BatchedDimension:
+    """Dimension lookup with a bounded LRU cache of lookup value -> surrogate key.
+
+    prefetch collects the values of a chunk of fact rows that are not cached
+    and resolves them with one WHERE lookupatt = ANY(%s) query. A lookup that
+    still misses the cache falls back to one SELECT.
+    """
+
+    def __init__(self, name, key, lookupatt, output_conn, cachesize=BATCHED_CACHE_SIZE):
+        self.name = name
+        self.key = key
+        self.lookupatts = [lookupatt]
+        self.lookupatt = lookupatt
+        self.output_conn = output_conn
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+        # values fetched by prefetch and not looked up yet, counted as misses on first lookup
+        self.prefetched = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.cache)}
+
+    def store(self, value, keyvalue):
+        self.cache[value] = keyvalue
+        self.cache.move_to_end(value)
+        if len(self.cache) > self.cachesize:
+            evicted, _ = self.cache.popitem(last=False)
+            self.prefetched.discard(evicted)
+            self.evictions += 1
+
+    # function to record a member added after its value was cached as missing
+    def remember(self, row, keyvalue):
+        self.store(row[self.lookupatt], keyvalue)
+
+    def fetch(self, values):
+        cursor = self.output_conn.cursor()
+        cursor.execute('SELECT {}, {} FROM {} WHERE {} = ANY(%s)'.format(
+            self.lookupatt, self.key, self.name, self.lookupatt), (list(values),))
+        found = dict(cursor.fetchall())
+        cursor.close()
+        # values that are not members are cached as None too, so they are not queried again
+        for value in values:
+            self.store(value, found.get(value))
+
+    def prefetch(self, rows, namemapping={}):
+        att = namemapping.get(self.lookupatt, self.lookupatt)
+        missing = set()
+        for row in rows:
+            value = row.get(att)
+            if value is not None and value not in self.cache:
+                missing.add(value)
+        if missing:
+            self.fetch(missing)
+            self.prefetched.update(missing)
+
+    def lookup(self, row, namemapping={}):
+        value = row[namemapping.get(self.lookupatt, self.lookupatt)]
+        if value is None:
+            return None
+        if value in self.cache:
+            if value in self.prefetched:
+                self.prefetched.discard(value)
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.cache.move_to_end(value)
+            return self.cache[value]
+        self.misses += 1
+        self.fetch([value])
+        return self.cache[value]
+
+
+# function to make the lookup of a dimension return a member inserted outside of it, like an inferred member
+def remember_member(dimension, row, keyvalue):
+    if hasattr(dimension, 'remember'):
+        dimension.remember(row, keyvalue)
+    else:
+        # pygrametl cached dimensions fill their cache through this hook after a lookup
+        dimension._after_lookup(row, {}, keyvalue)
+
+
+class LazyDimensions:
+    """Mapping of dimension name to lookup object, each created on first use.
+
+    Dimensions with one lookup attribute are read from a snapshot of their
+    current version, written first if it does not exist yet, unless their spec
+    sets 'lookup': 'batched' (bounded cache filled per chunk of fact rows),
+    'lookup': 'computed' (dim_datetime keys computed from the epoch) or
+    'lookup': 'prefill' (pygrametl cache prefilled with the whole dimension).
+    """
+
+    def __init__(self, output_conn, cache_dir=DIMENSION_CACHE_DIR, specs=DIMENSION_SPECS):
+        self.output_conn = output_conn
+        # one folder per data warehouse, cleanup of old versions only touches its own snapshots
+        self.cache_dir = get_dw_cache_dir(cache_dir, output_conn) if cache_dir else None
+        self.specs = specs
+        self.loaded = {}
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            logger.info('load dimension {}'.format(name))
+            self.loaded[name] = self.create(name, self.specs[name])
+        return self.loaded[name]
+
+    def cache_stats(self):
+        return dict((name, dimension.stats()) for name, dimension in self.loaded.items()
+                    if hasattr(dimension, 'stats'))
+
+    def create(self, name, spec):
+        lookup = spec.get('lookup', 'snapshot')
+        if len(spec['lookupatts']) == 1:
+            if lookup == 'computed':
+                try:
+                    return ComputedDatetimeDimension(self.output_conn, name, spec['key'], spec['lookupatts'][0])
+                except ValueError as e:
+                    logger.warning('{}, falling back to lookups'.format(e))
+                    lookup = 'snapshot'
+            if lookup == 'batched':
+                return BatchedDimension(name, spec['key'], spec['lookupatts'][0], self.output_conn)
+            if lookup == 'snapshot' and self.cache_dir:
+                return self.open_snapshot(name, spec)
+        dw_conn_wrapper = pygrametl.ConnectionWrapper(connection=self.output_conn)
+        size_argument = 'size' if spec['class'] is CachedDimension else 'cachesize'
+        return spec['class'](name=name, key=spec['key'], attributes=spec['attributes'],
+                             lookupatts=spec['lookupatts'], prefill=True, targetconnection=dw_conn_wrapper,
+                             **{size_argument: 0})
+
+    def open_snapshot(self, name, spec):
+        version = get_dimension_version(self.output_conn, name)
+        path = get_snapshot_path(self.cache_dir, name, version)
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_snapshot(self.output_conn, name, spec['key'], spec['lookupatts'][0], path)
+            # snapshots of older versions are not valid anymore, a worker that read a newer version keeps its file
+            for old_path in glob.glob(get_snapshot_path(self.cache_dir, name, '*')):
+                if int(os.path.basename(old_path).rsplit('.', 2)[1]) < version:
+                    try:
+                        os.remove(old_path)
+                    except FileNotFoundError:
+                        # removed by another fact worker rebuilding the same version
+                        pass
+        return SnapshotDimension(name, spec['key'], spec['lookupatts'][0], path)
@@ -1,37 +1,61 @@
 import logging
-from logging.handlers import RotatingFileHandler
-from logging.handlers import TimedRotatingFileHandler
-import sys
+import os
 import datetime
+import itertools
+import functools
 import pygrametl
-from pygrametl.tables import CachedDimension, TypeOneSlowlyChangingDimension
 from pygrametl.datasources import SQLSource
-
-
-# rotate log based on time
-def create_timed_rotating_log(path):
-    handler = TimedRotatingFileHandler(path, when="MIDNIGHT", interval=1, backupCount=5)
-    return handler
-
-
-# prepare for logging
-log_file = "etl_process.log"
-
-logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG,
-                    datefmt='%Y/%m/%d %I:%M:%S %p',
-                    handlers=[create_timed_rotating_log(log_file)])
+from config import connect_source, connect_dw
+from extract import PartitionedSource, ITERSIZE
+from pipeline import Pipeline
+from metrics import ObjectMetrics, cache_delta
+from reporting import RowTracer, Progress, PROGRESS_INTERVAL
+from unresolved import create_missing_key_handler
+from ddl import ensure_table, table_is_empty, get_factory_indexes, prepare_indexes, build_indexes
+from partitions import (PartitionManager, get_partition_columns, get_partitioned_create_sql, render_period,
+                        get_partition_name, parse_period, check_period_placeholder)
+from rollups import RollupMaintainer
+from rows import ROW_MODES, make_row_class, get_row_columns, compact_rows, row_bytes
+from bulk import create_fact_writer, create_dimension_writer
+from dimensions import LazyDimensions, DIMENSION_CACHE_DIR
+from control import (lock_object, bump_dimension_version, ensure_watermark_table, get_watermark, set_watermark,
+                     render_watermark, WatermarkTracker, take_quarantined_rows, ensure_checkpoint_table,
+                     get_checkpoint, render_checkpoint, Checkpoint)
+
+# logging is set up by reporting.configure_logging, called by run.py
 logger = logging.getLogger(__name__)
 
+# default number of rows held in memory between the source and the target
+CHUNK_SIZE = 10000
+
 
 # function to look up row ()
 def add_foreign_keys(row, keyrefs, dimensions):
+    missing = lookup_foreign_keys(row, keyrefs, dimensions)
+    if missing:
+        keyref, dim_name = missing[0]
+        logger.warning("{} was not present in the {}".format(keyref, dim_name))
+        raise ValueError("{} was not present in the {}".format(keyref, dim_name))
+    return row
+
+
+# function to look up the keyrefs of a row, returns the (keyref, dimension name) that were not found or None
+def lookup_foreign_keys(row, keyrefs, dimensions):
+    missing = None
     for keyref in keyrefs:
         dim_name = get_lookup_args(keyref)
         row[keyref] = dimensions[dim_name].lookup(row)
         if not row[keyref]:
-            logger.warning("{} was not present in the {}".format(keyref, dim_name))
-            raise ValueError("{} was not present in the {}".format(keyref, dim_name))
-    return row
+            missing = (missing or []) + [(keyref, dim_name)]
+    return missing
+
+
+# function to resolve the keyrefs of a chunk of rows in one query per dimension, where supported
+def prefetch_foreign_keys(rows, keyrefs, dimensions):
+    for keyref in keyrefs:
+        dimension = dimensions[get_lookup_args(keyref)]
+        if hasattr(dimension, 'prefetch'):
+            dimension.prefetch(rows)
 
 
 # function to get dimension name
@@ -40,172 +64,348 @@ def get_lookup_args(keyref):
     return dim_name
 
 
-def progress(count, total, status=''):
-    bar_len = 50
-    filled_len = int(round(bar_len * count / float(total)))
-    percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
-    sys.stdout.write('{} {}% {}/{} {}\r'.format(bar, percents, count, total, status))
-    sys.stdout.flush()
+# function to remove trailing semicolon so a query can be used as a subquery
+def strip_sql(sql):
+    return sql.strip().rstrip(';')
 
 
-def load_dimensions(output_conn):
-    dw_conn_wrapper = pygrametl.ConnectionWrapper(connection=output_conn)
-    ret = dict()
-    ret['dim_datetime'] = CachedDimension(
-        name='dim_datetime',
-        key='datetime_id',
-        attributes=['epoch',
-                    'minute',
-                    'minute_20',
-                    'minute_30',
-                    'hour',
-                    'day_of_week',
-                    'day_of_month',
-                    'week',
-                    'month',
-                    'year',
-                    'period'
-                    ],
-        lookupatts=['epoch'],
-        size=0,
-        prefill=True,
-        targetconnection=dw_conn_wrapper
-    )
-    ret['dim_location'] = TypeOneSlowlyChangingDimension(
-        name='dim_location',
-        key='location_id',
-        attributes=['lookup_location',
-                    'initial_id',
-                    'company_code',
-                    'street',
-                    'ward',
-                    'district',
-                    'city',
-                    'area',
-                    'country',
-                    'level1flag',
-                    'level2flag',
-                    'level3flag',
-                    'level4flag',
-                    'level5flag',
-                    'level6flag',
-                    ],
-        lookupatts=['lookup_location'],
-        cachesize=0,
-        prefill=True,
-        targetconnection=dw_conn_wrapper
-    )
-    ret['dim_employee'] = TypeOneSlowlyChangingDimension(
-        name='dim_employee',
-        key='employee_id',
-        attributes=['lookup_employee', 'initial_id', 'company_code', 'login', 'name', 'active', 'mobile', 'email'],
-        lookupatts=['lookup_employee'],
-        cachesize=0,
-        prefill=True,
-        targetconnection=dw_conn_wrapper
-    )
-    ret['dim_partner'] = TypeOneSlowlyChangingDimension(
-        name='dim_partner',
-        key='partner_id',
-        attributes=['lookup_partner', 'initial_id', 'company_code', 'name', 'ref', 'is_company', 'active', 'customer',
-                    'supplier',
-                    'employee', 'state', 'seq',
-                    'seq_order',
-                    'street_id', 'classify', 'total_sh'],
-        lookupatts=['lookup_partner'],
-        cachesize=0,
-        prefill=True,
-        targetconnection=dw_conn_wrapper
-    )
-
-    ret['dim_company'] = TypeOneSlowlyChangingDimension(
-        name='dim_company',
-        key='company_id',
-        attributes=['company_code', 'company_name'],
-        lookupatts=['company_code'],
-        cachesize=0,
-        prefill=True,
-        targetconnection=dw_conn_wrapper
-    )
-
-    return ret
-
-
-def transform_handle(class_name, object_name, data_source):
+# function to count rows of a source query with a cheap COUNT(*) pre-query
+def count_source_rows(source_conn, source_sql, parameters=None):
+    cursor = source_conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM ({}) AS count_source'.format(strip_sql(source_sql)), parameters)
+    total = cursor.fetchone()[0]
+    cursor.close()
+    return total
+
+
+# function to create a streaming data source over a server-side (named) cursor
+def create_source(source_conn, source_sql, object_name, parameters=None):
+    return SQLSource(connection=source_conn, query=source_sql,
+                     cursorarg='{}_cursor'.format(object_name), parameters=parameters)
+
+
+# function to create the data source of an object, range-partitioned when its factory declares a partition column
+def create_extract(pygram_factory, source_conn, source_sql, object_name, company_code, itersize=ITERSIZE,
+                   ordered=False):
+    column = pygram_factory.get('extract_partition_column')
+    if column and pygram_factory.get('extract_partitions', 1) > 1 and ordered:
+        # partitions are merged as they come, the order a checkpoint relies on would be lost
+        logger.warning('{} is checkpointed, extract_partitions is ignored'.format(object_name))
+    elif column and pygram_factory.get('extract_partitions', 1) > 1:
+        return PartitionedSource(functools.partial(connect_source, company_code), source_conn, source_sql,
+                                 object_name, column, pygram_factory['extract_partitions'], itersize)
+    return create_source(source_conn, source_sql, object_name)
+
+
+# function to split a row stream into lists of at most chunk_size rows
+def iter_chunks(rows, chunk_size=CHUNK_SIZE):
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+# function to get the dimensions of fact runs, each one is loaded on first lookup
+def load_dimensions(output_conn, cache_dir=DIMENSION_CACHE_DIR):
+    return LazyDimensions(output_conn, cache_dir=cache_dir)
+
+
+# function to render the {watermark} placeholder of the source query and create its tracker
+def prepare_watermark(pygram_factory, object_name, source_sql, source_conn, output_conn, company_code,
+                      full_refresh=False):
+    watermark_column = pygram_factory.get('watermark')
+    if not watermark_column:
+        return render_watermark(source_conn, source_sql, None, None), None
+
+    ensure_watermark_table(output_conn)
+    watermark = None
+    if full_refresh:
+        logger.info('full refresh of {}, watermark ignored'.format(object_name))
+    else:
+        watermark = get_watermark(output_conn, company_code, object_name)
+    logger.info('extract {} after watermark {}'.format(object_name, watermark))
+    source_sql = render_watermark(source_conn, source_sql, watermark_column, watermark)
+    tracker = WatermarkTracker(pygram_factory.get('watermark_field', watermark_column.split('.')[-1]))
+    return source_sql, tracker
+
+
+# function to advance the watermark once the load of the object has been committed
+def advance_watermark(tracker, object_name, output_conn, company_code):
+    if tracker is None or tracker.value is None:
+        return
+    set_watermark(output_conn, company_code, object_name, tracker.value)
+    output_conn.commit()
+
+
+# function to create the table of an object and its indexes, only what the catalog does not have yet
+def prepare_ddl(output_conn, table, create_sql, indexes, full_refresh=False):
+    """
+    An initial load (new or empty table) or a full refresh is a bulk load: the
+    deferrable indexes are dropped and returned, to be built after the load.
+    The lock of the object is held until the DDL is committed, so companies
+    loading into the same dw do not create or drop the same table and indexes
+    at once.
+    """
+    lock_object(output_conn, table)
+    created = ensure_table(output_conn, table, create_sql)
+    if created:
+        logger.info('{} created'.format(table))
+        print('{} created'.format(table))
+    bulk = created or full_refresh or table_is_empty(output_conn, table)
+    deferred = prepare_indexes(output_conn, table, indexes, bulk)
+    output_conn.commit()
+    return deferred
+
+
+# function to get the connection factory used to build indexes in parallel, None builds them one by one
+def get_index_connect(company_code):
+    if not company_code:
+        return None
+    return functools.partial(connect_dw, company_code)
+
+
+# function to order the source query by the checkpoint key of the factory and create its checkpoint
+def prepare_checkpoint(pygram_factory, object_name, source_sql, source_conn, output_conn, company_code,
+                       checkpoint_rows=0, checkpoint_seconds=0, resume=False):
+    checkpoint_key = pygram_factory.get('checkpoint_key')
+    if not checkpoint_key or not (checkpoint_rows or checkpoint_seconds or resume):
+        return source_sql, None
+
+    ensure_checkpoint_table(output_conn)
+    stored = get_checkpoint(output_conn, company_code, object_name)
+    last, rows = None, 0
+    if stored and resume:
+        last, rows = stored
+        logger.info('resume {} after {} {}, {} rows loaded before'.format(object_name, checkpoint_key, last, rows))
+        print('resume {} after {} {}, {} rows loaded before'.format(object_name, checkpoint_key, last, rows))
+    elif stored:
+        logger.info('checkpoint of {} ignored without --resume, start over'.format(object_name))
+    source_sql = render_checkpoint(source_conn, source_sql, checkpoint_key, last)
+    return source_sql, Checkpoint(output_conn, company_code, object_name, checkpoint_key, checkpoint_rows,
+                                  checkpoint_seconds, rows)
+
+
+# function to apply the batch api of a transform to each chunk of its rows
+def apply_batch_transform(rows, run_class, chunk_size=CHUNK_SIZE):
+    for chunk in iter_chunks(rows, chunk_size):
+        run_class.apply_batch(chunk)
+        for row in chunk:
+            yield row
+
+
+# function to get the transformed rows in chunks, with extract and transform as concurrent stages when pipelined
+def get_chunks(data_source, transform, chunk_size=CHUNK_SIZE, pipelined=False):
+    if pipelined:
+        return Pipeline().run(data_source, transform, chunk_size)
+    return iter_chunks(transform(data_source), chunk_size)
+
+
+def transform_handle(class_name, object_name, data_source, company_code=None, chunk_size=CHUNK_SIZE):
     run_class = class_name()
+    run_class.company_code = company_code
     final_source = run_class.run_class_function(object_name=object_name, data_source=data_source)
+    # transforms that opt in to the batch api convert their helper columns a chunk at a time
+    if getattr(run_class, 'batch_steps', None):
+        final_source = apply_batch_transform(final_source, run_class, chunk_size)
     return final_source
 
 
+# function to get the transform of an object run, in compact row mode its rows keep only the given columns
+def get_row_transform(class_name, object_name, company_code, chunk_size, metrics, row_mode='dict', columns=()):
+    if row_mode not in ROW_MODES:
+        raise ValueError('unknown row mode {}'.format(row_mode))
+    row_class = make_row_class(columns) if row_mode == 'compact' else None
+
+    def transform(rows):
+        rows = transform_handle(class_name, object_name, rows, company_code, chunk_size)
+        if row_class:
+            rows = compact_rows(rows, row_class)
+        return metrics.timed('transform', rows, chunk_size)
+    return transform
+
+
+# function to close the metrics of an object run and log them
+def finish_metrics(metrics, rows, source_conn, output_conn, pipelined=False, cache=None):
+    # without the pipeline the transform stage pulls its rows from extract, its time includes extract
+    if not pipelined and 'transform' in metrics.seconds:
+        metrics.seconds['transform'] -= metrics.seconds.get('extract', 0)
+    metrics.stop_round_trips(source_conn, output_conn)
+    metrics.finish(rows, cache)
+    logger.info('metrics of {}: {}'.format(metrics.object_name, metrics.as_dict()))
+
+
+# function to run one dimension object of GetObjects
+# returns the metrics of the run
+def run_dimension_object(d, src_pgconn, dw_pgconn, etl_options):
+    metrics = ObjectMetrics(etl_options.get('company_code'), d['name'], 'dimension')
+    run_dimension_etl(dimension_name=d['name'],
+                      class_name=d['class'],
+                      pygram_dimension_factory=d["dimension_handler"],
+                      source_conn=src_pgconn,
+                      output_conn=dw_pgconn,
+                      source_sql=d["source_sql"],
+                      create_sql=d["create_sql"],
+                      metrics=metrics,
+                      **etl_options)
+    return metrics.as_dict()
+
+
+# function to run one fact object of GetObjects
+# returns the metrics of the run
+def run_fact_object(f, src_pgconn, dw_pgconn, list_dimensions, etl_options):
+    metrics = ObjectMetrics(etl_options.get('company_code'), f['name'], 'fact')
+    run_fact_etl(fact_name=f['name'],
+                 class_name=f['class'],
+                 pygram_fact_factory=f["fact_handler"],
+                 source_conn=src_pgconn,
+                 output_conn=dw_pgconn,
+                 source_sql=f["source_sql"],
+                 create_sql=f["create_sql"],
+                 dimensions=list_dimensions,
+                 metrics=metrics,
+                 **etl_options)
+    return metrics.as_dict()
+
+
 def run_dimension_etl(dimension_name, class_name, pygram_dimension_factory, source_sql,
                       source_conn, output_conn,
-                      create_sql):
+                      create_sql, chunk_size=CHUNK_SIZE, count_rows=False, company_code=None,
+                      full_refresh=False, itersize=ITERSIZE, pipelined=False, metrics=None, trace_rows=0,
+                      progress_interval=PROGRESS_INTERVAL, checkpoint_rows=0, checkpoint_seconds=0, resume=False,
+                      row_mode='dict'):
     """
     This function can be used in any kind of workflow (for example in a celery
     task) or in a simple main program.
     """
     # TODO: add null user to employee dimension
+    company_code = company_code or os.getenv('SRC_COMPANY_CODE')
+    metrics = metrics or ObjectMetrics(company_code, dimension_name, 'dimension')
+    metrics.start_round_trips(source_conn, output_conn)
     # print current time
     print('current time is {}'.format(datetime.datetime.now()))
     # connection wrapper
     dw_conn_wrapper = pygrametl.ConnectionWrapper(connection=output_conn)
 
-    # create dimension table by create_sql
-    cursor = output_conn.cursor()
-    logger.info('create {} if not exist'.format(dimension_name))
-    print('create {} if not exist'.format(dimension_name))
-    cursor.execute(create_sql)
-    output_conn.commit()
+    # create dimension table by create_sql, lookupatts indexes are kept during loads since the sync looks them up
+    with metrics.stage('ddl'):
+        deferred_indexes = prepare_ddl(output_conn, dimension_name, create_sql,
+                                       get_factory_indexes(pygram_dimension_factory, dimension_name,
+                                                           pygram_dimension_factory['lookupatts']),
+                                       full_refresh)
 
-    # create index for dimension
-    logger.info('create index of {} if not exist'.format(dimension_name))
-    print('create index of {} if not exist'.format(dimension_name))
-    for lookupatt in pygram_dimension_factory['lookupatts']:
-        cursor.execute('''CREATE INDEX IF NOT EXISTS {}_{}_idx
-                      ON {}({})'''.format(dimension_name, lookupatt, dimension_name, lookupatt))
-    output_conn.commit()
+    # serialize writers of the same dimension, companies loading into the same dw share its tables
+    lock_object(output_conn, dimension_name)
 
-    # Create dimension
-    pygram_dim_class = pygram_dimension_factory["class"]
-    pygram_dim_object = pygram_dim_class(
-        name=pygram_dimension_factory["name"],
-        key=pygram_dimension_factory["key"],
-        attributes=pygram_dimension_factory["attributes"],
-        lookupatts=pygram_dimension_factory["lookupatts"],
-        targetconnection=dw_conn_wrapper,
-        cachesize=0,
-        prefill=True)
+    # Create dimension writer, per row scdensure or set-based sync as selected in the factory
+    dimension_writer = create_dimension_writer(pygram_dimension_factory, output_conn, dw_conn_wrapper)
 
     # TODO: handle datetime dimension here
 
     # Create data_source
     logger.info('start query {}'.format(dimension_name))
     print('start query {}'.format(dimension_name))
+    length_source = None
+    tracker = None
+    checkpoint = None
     if dimension_name in ['dim_datetime', 'dim_company', 'dim_call_center', 'dim_dong_ho_o', 'dim_dong_ho_tong',
                           'dim_hoa_don_tai_chinh']:
         final_source = source_sql
+        if hasattr(final_source, '__len__'):
+            length_source = len(final_source)
+        chunks = iter_chunks(final_source, chunk_size)
 
     else:
-        data_source = SQLSource(connection=source_conn, query=source_sql)
-        final_source = transform_handle(class_name, dimension_name, data_source)
-
-    # Ensure row into dimension
-    list_data_source = list(final_source)
-    length_source = len(list_data_source)
+        source_sql, tracker = prepare_watermark(pygram_dimension_factory, dimension_name, source_sql,
+                                                source_conn, output_conn, company_code, full_refresh)
+        source_sql, checkpoint = prepare_checkpoint(pygram_dimension_factory, dimension_name, source_sql,
+                                                    source_conn, output_conn, company_code, checkpoint_rows,
+                                                    checkpoint_seconds, resume)
+        if count_rows:
+            length_source = count_source_rows(source_conn, source_sql)
+        data_source = create_extract(pygram_dimension_factory, source_conn, source_sql, dimension_name,
+                                     company_code, itersize, ordered=checkpoint is not None)
+        if tracker:
+            data_source = tracker.track(data_source)
+        data_source = metrics.timed('extract', data_source, chunk_size)
+        chunks = get_chunks(data_source,
+                            get_row_transform(class_name, dimension_name, company_code, chunk_size, metrics,
+                                              row_mode, get_row_columns(pygram_dimension_factory)),
+                            chunk_size, pipelined)
+
+    # Ensure row into dimension, chunk by chunk
+    tracer = RowTracer(dimension_name, list(pygram_dimension_factory['lookupatts']) +
+                       list(pygram_dimension_factory.get('attributes', [])), trace_rows)
+    progress = Progress(length_source, dimension_name, progress_interval)
     count = 1
-    for row in list_data_source:
-        pygram_dim_object.scdensure(row)
-        progress(count, length_source, status='{}'.format(dimension_name))
-        count += 1
+    # number and row of the current row, reported when it fails
+    position, row = 0, None
+    # changes already covered by a version bump
+    bumped = 0
+    # last row of the previous chunk, a checkpoint is taken after it once the next chunk shows the key changed
+    last_row = None
+    try:
+        for chunk in chunks:
+            if checkpoint and last_row is not None and checkpoint.due(count - 1) and \
+                    checkpoint.boundary(last_row, chunk[0]):
+                with metrics.stage('commit'):
+                    if dimension_writer.changed > bumped:
+                        bump_dimension_version(output_conn, dimension_name)
+                        bumped = dimension_writer.changed
+                    checkpoint.save(last_row, count - 1)
+                    output_conn.commit()
+                    # the commit released the lock, keys are read again under the new one
+                    lock_object(output_conn, dimension_name)
+                    dimension_writer.checkpoint()
+            if count == 1:
+                metrics.count('row_bytes', row_bytes(chunk))
+            with metrics.stage('load', len(chunk)):
+                for position, row in enumerate(chunk, count):
+                    dimension_writer.ensure(row)
+                    if tracer.every and not position % tracer.every:
+                        tracer.trace(position, row)
+                    progress.update(position)
+                count += len(chunk)
+                position, row = 0, None
+                dimension_writer.flush()
+            last_row = chunk[-1]
+    except Exception as e:
+        tracer.failed(position, row, e)
+        # stop the extract and transform stages before the transaction they may still read is rolled back
+        chunks.close()
+        output_conn.rollback()
+        raise
+    progress.done(count - 1)
     print('done')
 
-    output_conn.commit()
+    # a new version invalidates the lookup snapshots of fact runs
+    with metrics.stage('commit'):
+        if dimension_writer.changed > bumped:
+            bump_dimension_version(output_conn, dimension_name)
+        if checkpoint:
+            checkpoint.clear()
+        output_conn.commit()
+        advance_watermark(tracker, dimension_name, output_conn, company_code)
+    if deferred_indexes:
+        with metrics.stage('index'):
+            build_indexes(output_conn, dimension_name, deferred_indexes, get_index_connect(company_code))
+    if checkpoint:
+        metrics.count('checkpoints', checkpoint.taken)
+    finish_metrics(metrics, count - 1, source_conn, output_conn, pipelined)
+    return count - 1
 
 
 def run_fact_etl(fact_name, class_name, pygram_fact_factory,
                  source_sql, source_conn, output_conn,
-                 create_sql, dimensions={}):
+                 create_sql, dimensions={}, chunk_size=CHUNK_SIZE, count_rows=False, company_code=None,
+                 full_refresh=False, itersize=ITERSIZE, pipelined=False, metrics=None, trace_rows=0,
+                 progress_interval=PROGRESS_INTERVAL, reprocess_quarantine=False, checkpoint_rows=0,
+                 checkpoint_seconds=0, resume=False, replace_period=None, row_mode='dict'):
+    company_code = company_code or os.getenv('SRC_COMPANY_CODE')
+    metrics = metrics or ObjectMetrics(company_code, fact_name, 'fact')
+    metrics.start_round_trips(source_conn, output_conn)
+    cache_before = dimensions.cache_stats() if hasattr(dimensions, 'cache_stats') else {}
     # print current time
     print('current time is {}'.format(datetime.datetime.now()))
 
@@ -213,58 +413,184 @@ def run_fact_etl(fact_name, class_name, pygram_fact_factory,
     dw_conn_wrapper = pygrametl.ConnectionWrapper(connection=output_conn)
     # TODO: add try statement to raise error
 
-    # create fact_table_object
-    pygram_fact_class = pygram_fact_factory["class"]
-    pygram_fact_object = pygram_fact_class(
-        name=pygram_fact_factory["name"],
-        measures=pygram_fact_factory["measures"],
-        keyrefs=pygram_fact_factory["keyrefs"],
-        targetconnection=dw_conn_wrapper)
-
-    # create fact table by create_sql
-    cursor = output_conn.cursor()
-    logger.info('create {} if not exist'.format(fact_name))
-    print('create {} if not exist'.format(fact_name))
-    cursor.execute(create_sql)
-    output_conn.commit()
-
-    # create index for each item of primary key group
-    logger.info('create index of {} if not exist'.format(fact_name))
-    print('create index of {} if not exist'.format(fact_name))
-    for keyref in pygram_fact_factory['keyrefs']:
-        cursor.execute('''CREATE INDEX IF NOT EXISTS {}_{}_idx
-                  ON {}({})'''.format(fact_name, keyref, fact_name, keyref))
-    output_conn.commit()
-
-    # Create data_source
-    logger.info('start query {}'.format(fact_name))
-    print('start query {}'.format(fact_name))
-    data_source = SQLSource(connection=source_conn, query=source_sql)
-
-    # handle fact
-    final_source = transform_handle(class_name, fact_name, data_source)
-
-    # ensure into fact table
-    list_data_source = list(final_source)
-    length_source = len(list_data_source)
-    if length_source == 0:
+    # monthly range partitions on datetime_id or on period columns, as declared in the factory
+    partition_spec = pygram_fact_factory.get('partition')
+    if partition_spec:
+        missing_columns = [column for column in get_partition_columns(partition_spec)
+                           if column not in pygram_fact_factory['keyrefs'] + pygram_fact_factory['measures']]
+        if missing_columns:
+            raise ValueError('partition columns {} of {} are not keyrefs or measures'.format(missing_columns,
+                                                                                          fact_name))
+        # the unique index the COPY writer merges on must contain the partition columns
+        missing_columns = [column for column in get_partition_columns(partition_spec)
+                           if column not in pygram_fact_factory['keyrefs']]
+        if missing_columns and pygram_fact_factory.get('writer') == 'copy':
+            raise ValueError('partition columns {} of {} must be keyrefs with the copy writer'.format(
+                missing_columns, fact_name))
+        create_sql = get_partitioned_create_sql(create_sql, partition_spec)
+    elif replace_period:
+        raise ValueError('{} has no partition, a period cannot be replaced'.format(fact_name))
+    if not reprocess_quarantine:
+        check_period_placeholder(source_sql, replace_period)
+
+    # create fact table by create_sql, the keyref indexes are deferred when the COPY writer does not look them up
+    with metrics.stage('ddl'):
+        deferred_indexes = prepare_ddl(output_conn, fact_name, create_sql,
+                                       get_factory_indexes(pygram_fact_factory, fact_name,
+                                                           pygram_fact_factory['keyrefs'],
+                                                           defer=pygram_fact_factory.get('writer') == 'copy'),
+                                       full_refresh and not replace_period)
+        partitions = PartitionManager(output_conn, fact_name, partition_spec) if partition_spec else None
+
+        # a replaced period is loaded into a new table, swapped in before the commit
+        target_factory = pygram_fact_factory
+        if replace_period:
+            lock_object(output_conn, fact_name)
+            target_factory = dict(pygram_fact_factory, name=partitions.create_period_table(replace_period))
+            logger.info('replace period {} of {}'.format(replace_period, fact_name))
+            print('replace period {} of {}'.format(replace_period, fact_name))
+
+        # rollups follow the inserted rows, or are recomputed for the groups of a replaced period
+        rollups = RollupMaintainer(output_conn, fact_name, pygram_fact_factory)
+        rollups.ensure()
+
+        # create fact writer, per row ensure or bulk COPY as selected in the factory
+        fact_writer = create_fact_writer(target_factory, output_conn, dw_conn_wrapper,
+                                         track_delta=bool(rollups.rollups) and not replace_period)
+        # raise, quarantine or infer a member when a keyref is not found, as selected in the factory
+        missing_keys = create_missing_key_handler(pygram_fact_factory, output_conn, company_code, dimensions,
+                                                  functools.partial(connect_dw, company_code) if company_code
+                                                  else None)
+
+    if reprocess_quarantine:
+        # quarantined rows are already transformed, they leave the quarantine when the load is committed
+        logger.info('reprocess quarantined rows of {}'.format(fact_name))
+        print('reprocess quarantined rows of {}'.format(fact_name))
+        tracker = checkpoint = None
+        data_source = take_quarantined_rows(output_conn, company_code, fact_name)
+        length_source = len(data_source)
+        chunks = iter_chunks(data_source, chunk_size)
+    else:
+        # Create data_source
+        logger.info('start query {}'.format(fact_name))
+        print('start query {}'.format(fact_name))
+        source_sql = render_period(source_conn, source_sql, pygram_fact_factory.get('period_column'), replace_period)
+        if replace_period:
+            # the period is reloaded whole in one transaction, without watermark or checkpoints
+            tracker = checkpoint = None
+            source_sql = render_watermark(source_conn, source_sql, None, None)
+        else:
+            source_sql, tracker = prepare_watermark(pygram_fact_factory, fact_name, source_sql,
+                                                    source_conn, output_conn, company_code, full_refresh)
+            source_sql, checkpoint = prepare_checkpoint(pygram_fact_factory, fact_name, source_sql, source_conn,
+                                                        output_conn, company_code, checkpoint_rows,
+                                                        checkpoint_seconds, resume)
+        length_source = None
+        if count_rows:
+            length_source = count_source_rows(source_conn, source_sql)
+        data_source = create_extract(pygram_fact_factory, source_conn, source_sql, fact_name, company_code,
+                                     itersize, ordered=checkpoint is not None)
+        if tracker:
+            data_source = tracker.track(data_source)
+        data_source = metrics.timed('extract', data_source, chunk_size)
+
+        # handle fact
+        # compact rows also keep the lookup attributes of the dimensions of the keyrefs
+        lookup_columns = [column for keyref in pygram_fact_factory['keyrefs']
+                          for column in getattr(dimensions, 'specs', {}).get(get_lookup_args(keyref), {}).get(
+                              'lookupatts', [])]
+        chunks = get_chunks(data_source,
+                            get_row_transform(class_name, fact_name, company_code, chunk_size, metrics, row_mode,
+                                              get_row_columns(pygram_fact_factory, lookup_columns)),
+                            chunk_size, pipelined)
+
+    # ensure into fact table, chunk by chunk
+    keyrefs = pygram_fact_factory["keyrefs"]
+    # sampled trace of keyrefs and measures, instead of a debug record per row
+    tracer = RowTracer(fact_name, list(keyrefs) + list(pygram_fact_factory['measures']), trace_rows)
+    progress = Progress(length_source, fact_name, progress_interval)
+    count = 1
+    # number and row of the current row, reported when it fails
+    position, row = 0, None
+    # last row of the previous chunk, a checkpoint is taken after it once the next chunk shows the key changed
+    last_row = None
+    try:
+        for chunk in chunks:
+            if checkpoint and last_row is not None and checkpoint.due(count - 1) and \
+                    checkpoint.boundary(last_row, chunk[0]):
+                with metrics.stage('commit'):
+                    missing_keys.commit()
+                    checkpoint.save(last_row, count - 1)
+                    output_conn.commit()
+            if count == 1:
+                metrics.count('row_bytes', row_bytes(chunk))
+            with metrics.stage('lookup', len(chunk)):
+                prefetch_foreign_keys(chunk, keyrefs, dimensions)
+                loaded = []
+                for position, row in enumerate(chunk, count):
+                    missing = lookup_foreign_keys(row, keyrefs, dimensions)
+                    # rows the handler quarantines are not loaded
+                    if missing and not missing_keys.handle(row, missing):
+                        continue
+                    loaded.append(row)
+            with metrics.stage('load', len(loaded)):
+                if partitions and not replace_period:
+                    partitions.ensure(loaded)
+                for position, row in enumerate(loaded, count):
+                    # The row can then be inserted into the fact table
+                    fact_writer.ensure(row)
+                    if tracer.every and not position % tracer.every:
+                        tracer.trace(position, row)
+                    progress.update(position)
+                count += len(loaded)
+                position, row = 0, None
+                fact_writer.flush()
+                missing_keys.flush()
+            if fact_writer.delta:
+                with metrics.stage('rollup', len(fact_writer.delta)):
+                    rollups.apply(fact_writer.take_delta())
+            last_row = chunk[-1]
+        missing_keys.finish()
+        if replace_period:
+            with metrics.stage('swap'):
+                old_partition = get_partition_name(fact_name, *parse_period(replace_period))
+                if rollups.rollups:
+                    rollups.collect([target_factory['name']] + ([old_partition] if old_partition in
+                                                                partitions.partitions else []))
+                partitions.replace(replace_period, target_factory['name'])
+                if rollups.rollups:
+                    rollups.recompute()
+    except Exception as e:
+        tracer.failed(position, row, e)
+        # stop the extract and transform stages before the transaction they may still read is rolled back
+        chunks.close()
+        # members already inferred are committed, only the connection they were inserted on is closed
+        missing_keys.close()
+        output_conn.rollback()
+        raise
+    progress.done(count - 1)
+    if count == 1:
         logger.info('no record in query period')
         print('no record in query period')
-    else:
-        count = 1
-        for row in list_data_source:
-            row = add_foreign_keys(
-                row, pygram_fact_factory["keyrefs"], dimensions)
-            # logger debug pkey and value of row
-            dict_keyref = {}
-            for keyref in pygram_fact_factory['keyrefs']:
-                dict_keyref[keyref] = row[keyref]
-            for measure in pygram_fact_factory['measures']:
-                dict_keyref[measure] = row[measure]
-            logger.debug('row {}:{}'.format(count, dict_keyref))
-            # The row can then be inserted into the fact table
-            pygram_fact_object.ensure(row)
-            progress(count, length_source, status='{}'.format(fact_name))
-            count += 1
     print('done')
-    output_conn.commit()
+    with metrics.stage('commit'):
+        if checkpoint:
+            checkpoint.clear()
+        output_conn.commit()
+        advance_watermark(tracker, fact_name, output_conn, company_code)
+    if deferred_indexes:
+        with metrics.stage('index'):
+            build_indexes(output_conn, fact_name, deferred_indexes, get_index_connect(company_code))
+    metrics.count('quarantined', missing_keys.quarantined)
+    metrics.count('inferred', missing_keys.inferred)
+    if rollups.rollups:
+        metrics.count('rollup_rows', rollups.merged)
+    if checkpoint:
+        metrics.count('checkpoints', checkpoint.taken)
+    cache = {}
+    if hasattr(dimensions, 'cache_stats'):
+        cache = cache_delta(cache_before, dimensions.cache_stats())
+        for dim_name, stats in cache.items():
+            logger.info('{} cache of {}: {}'.format(fact_name, dim_name, stats))
+    finish_metrics(metrics, count - 1, source_conn, output_conn, pipelined, cache)
+    return count - 1
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# rows fetched per round trip by the server-side cursor of each partition
+ITERSIZE = 2000
+
+# marker put on the queue by a reader when its partition is exhausted
+PARTITION_DONE = object()
+
+
+# function to split the range of a partition column into at most n (low, high, last) ranges
+def get_partition_ranges(source_conn, source_sql, column, partitions):
+    cursor = source_conn.cursor()
+    cursor.execute('SELECT MIN({}), MAX({}) FROM ({}) AS partition_source'.format(
+        column, column, source_sql.strip().rstrip(';')))
+    low, high = cursor.fetchone()
+    cursor.close()
+    if low is None:
+        return []
+    # works for numbers, dates and datetimes: high - low is a number or a timedelta
+    bounds = []
+    for i in range(partitions):
+        bound = low + (high - low) * i // partitions
+        if not bounds or bound != bounds[-1]:
+            bounds.append(bound)
+    bounds.append(high)
+    return [(bounds[i], bounds[i + 1], i == len(bounds) - 2) for i in range(len(bounds) - 1)]
+
+
+class PartitionedSource:
+    """Read a source query as range partitions of one column, in parallel.
+
+    Each partition is read by its own thread, on its own connection, through a
+    server-side named cursor. Rows are merged through a bounded queue, so
+    memory stays bounded when the consumer is slower than the readers. Rows
+    whose column is NULL are read as one more partition. The source connection
+    exports its snapshot and every reader imports it, so all partitions see
+    the same data even while the source is written.
+    """
+
+    def __init__(self, source_connect, source_conn, source_sql, object_name, column, partitions,
+                 itersize=ITERSIZE):
+        self.source_connect = source_connect
+        self.source_conn = source_conn
+        self.source_sql = source_sql.strip().rstrip(';')
+        self.object_name = object_name
+        self.column = column
+        self.partitions = partitions
+        self.itersize = itersize
+
+    def get_queries(self):
+        ranges = get_partition_ranges(self.source_conn, self.source_sql, self.column, self.partitions)
+        cursor = self.source_conn.cursor()
+        queries = []
+        for low, high, last in ranges:
+            # bounds are inlined so % in the source query does not need escaping
+            predicate = cursor.mogrify('{} >= %s AND {} {} %s'.format(self.column, self.column, '<=' if last else '<'),
+                                       (low, high)).decode('utf8')
+            queries.append('SELECT * FROM ({}) AS partition_source WHERE {}'.format(self.source_sql, predicate))
+        queries.append('SELECT * FROM ({}) AS partition_source WHERE {} IS NULL'.format(self.source_sql, self.column))
+        cursor.close()
+        return queries
+
+    # function to start a repeatable read transaction on the source connection and export its snapshot
+    def export_snapshot(self):
+        self.source_conn.rollback()
+        cursor = self.source_conn.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT pg_export_snapshot()')
+        snapshot = cursor.fetchone()[0]
+        cursor.close()
+        return snapshot
+
+    def put(self, rows_queue, abort, item):
+        while not abort.is_set():
+            try:
+                rows_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read_partition(self, index, query, snapshot, rows_queue, abort):
+        try:
+            conn = self.source_connect()
+            try:
+                # the snapshot must be imported before the first query of the transaction
+                setup = conn.cursor()
+                setup.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                setup.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                setup.close()
+                cursor = conn.cursor('{}_partition_{}'.format(self.object_name, index))
+                cursor.itersize = self.itersize
+                cursor.execute(query)
+                while not abort.is_set():
+                    data = cursor.fetchmany(self.itersize)
+                    if not data:
+                        break
+                    names = [t[0] for t in cursor.description]
+                    self.put(rows_queue, abort, [dict(zip(names, row)) for row in data])
+                cursor.close()
+            finally:
+                conn.close()
+            self.put(rows_queue, abort, PARTITION_DONE)
+        except Exception as e:
+            self.put(rows_queue, abort, e)
+
+    def __iter__(self):
+        # the exporting transaction stays open until every reader is done
+        snapshot = self.export_snapshot()
+        queries = self.get_queries()
+        logger.info('extract {} in {} partitions of {}'.format(self.object_name, len(queries), self.column))
+        rows_queue = queue.Queue(maxsize=2 * max(len(queries), 1))
+        abort = threading.Event()
+        threads = [threading.Thread(target=self.read_partition, args=(index, query, snapshot, rows_queue, abort),
+                                    daemon=True)
+                   for index, query in enumerate(queries)]
+        for thread in threads:
+            thread.start()
+        try:
+            remaining = len(threads)
+            while remaining:
+                item = rows_queue.get()
+                if item is PARTITION_DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for row in item:
+                        yield row
+        finally:
+            abort.set()
+            for thread in threads:
+                thread.join()
+            self.source_conn.rollback()
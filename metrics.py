@@ -0,0 +1,215 @@
+import contextlib
+import cProfile
+import datetime
+import itertools
+import json
+import logging
+import os
+import time
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# folder of the json run reports, the prometheus textfile and the profiles
+METRICS_DIR = os.path.join(os.getcwd(), 'reports')
+# rows pulled between two clock reads of a timed stage, timing each row costs more than the stage itself
+TIMED_CHUNK_SIZE = 1000
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor counting the round trips to the database on its connection."""
+
+    def count(self):
+        self.connection.round_trips += 1
+
+    def execute(self, query, vars=None):
+        self.count()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self.count()
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.count()
+        return super().copy_expert(sql, file, size)
+
+    # a named (server-side) cursor goes to the server for every fetch
+    def fetchone(self):
+        if self.name:
+            self.count()
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        if self.name:
+            self.count()
+        return super().fetchmany(self.arraysize if size is None else size)
+
+    def fetchall(self):
+        if self.name:
+            self.count()
+        return super().fetchall()
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection whose cursors count round trips in round_trips."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.cursor_factory = CountingCursor
+
+
+# function to read the round trip counter of a connection, 0 for connections that do not count
+def get_round_trips(conn):
+    return getattr(conn, 'round_trips', 0)
+
+
+class ObjectMetrics:
+    """Wall time and row count per stage of one object run."""
+
+    def __init__(self, company_code, object_name, object_type):
+        self.company_code = company_code
+        self.object_name = object_name
+        self.object_type = object_type
+        self.seconds = {}
+        self.rows = {}
+        self.cache = {}
+        self.round_trips = {}
+        self.counters = {}
+        self.start = time.time()
+        self.end = None
+
+    def add(self, stage, seconds, rows=0):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        self.rows[stage] = self.rows.get(stage, 0) + rows
+
+    def count(self, counter, value):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, stage, rows=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, rows)
+
+    # function to time a row stream a chunk at a time, the time spent producing each chunk is added to the stage
+    def timed(self, stage, rows, chunk_size=TIMED_CHUNK_SIZE):
+        iterator = iter(rows)
+        while True:
+            start = time.time()
+            chunk = list(itertools.islice(iterator, chunk_size))
+            self.add(stage, time.time() - start, len(chunk))
+            if not chunk:
+                return
+            yield from chunk
+
+    def start_round_trips(self, source_conn, output_conn):
+        self.round_trips_start = (get_round_trips(source_conn), get_round_trips(output_conn))
+
+    def stop_round_trips(self, source_conn, output_conn):
+        self.round_trips = {'source': get_round_trips(source_conn) - self.round_trips_start[0],
+                            'dw': get_round_trips(output_conn) - self.round_trips_start[1]}
+
+    def finish(self, rows, cache=None):
+        self.end = time.time()
+        self.rows['total'] = rows
+        self.cache = cache or {}
+
+    def as_dict(self):
+        wall = (self.end or time.time()) - self.start
+        return {
+            'company_code': self.company_code,
+            'object': self.object_name,
+            'type': self.object_type,
+            'rows': self.rows.get('total', 0),
+            'wall_seconds': round(wall, 3),
+            'rows_per_second': round(self.rows.get('total', 0) / wall, 1) if wall else 0,
+            'stage_seconds': dict((stage, round(seconds, 3)) for stage, seconds in self.seconds.items()),
+            'stage_rows': dict((stage, rows) for stage, rows in self.rows.items() if stage != 'total'),
+            'round_trips': self.round_trips,
+            'counters': self.counters,
+            'cache': self.cache,
+        }
+
+
+# function to get the cache counters of one object run, dimension caches are shared by the facts of a run
+def cache_delta(before, after):
+    delta = {}
+    for name, stats in after.items():
+        previous = before.get(name, {})
+        delta[name] = dict((counter, value if counter == 'size' else value - previous.get(counter, 0))
+                           for counter, value in stats.items())
+        lookups = delta[name].get('hits', 0) + delta[name].get('misses', 0)
+        delta[name]['hit_rate'] = round(delta[name].get('hits', 0) / lookups, 4) if lookups else None
+    return delta
+
+
+# function to write a file atomically, so a collector never reads half of it
+def write_atomic(path, content):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# function to format one prometheus sample
+def prometheus_sample(name, labels, value):
+    return '{}{{{}}} {}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())), value)
+
+
+# function to write the results of a run as a json report and a prometheus textfile-collector file
+def write_run_report(results, metrics_dir=METRICS_DIR, name='etl'):
+    os.makedirs(metrics_dir, exist_ok=True)
+    now = datetime.datetime.now()
+    report = {'finished_at': now.isoformat(), 'objects': results}
+    json_path = os.path.join(metrics_dir, '{}_{}.json'.format(name, now.strftime('%Y%m%d_%H%M%S')))
+    write_atomic(json_path, json.dumps(report, indent=2, default=str))
+
+    lines = ['# TYPE etl_object_success gauge', '# TYPE etl_object_rows gauge',
+             '# TYPE etl_object_rows_per_second gauge', '# TYPE etl_object_stage_seconds gauge',
+             '# TYPE etl_object_counter gauge', '# TYPE etl_object_db_round_trips gauge',
+             '# TYPE etl_dimension_cache gauge', '# TYPE etl_last_run_timestamp_seconds gauge']
+    for result in results:
+        metrics = result.get('metrics') or {}
+        # names of multi-company runs are prefixed by the company code
+        labels = {'company': result.get('company_code') or '', 'object': result['name'].split('.')[-1],
+                  'type': result['type']}
+        lines.append(prometheus_sample('etl_object_success', labels, 1 if result['status'] == 'done' else 0))
+        lines.append(prometheus_sample('etl_object_rows', labels, result.get('rows', 0)))
+        if not metrics:
+            continue
+        lines.append(prometheus_sample('etl_object_rows_per_second', labels, metrics['rows_per_second']))
+        lines.append(prometheus_sample('etl_object_stage_seconds', dict(labels, stage='total'),
+                                       metrics['wall_seconds']))
+        for stage, seconds in metrics['stage_seconds'].items():
+            lines.append(prometheus_sample('etl_object_stage_seconds', dict(labels, stage=stage), seconds))
+        for counter, value in metrics['counters'].items():
+            lines.append(prometheus_sample('etl_object_counter', dict(labels, counter=counter), value))
+        for db, round_trips in metrics['round_trips'].items():
+            lines.append(prometheus_sample('etl_object_db_round_trips', dict(labels, db=db), round_trips))
+        for dimension, stats in metrics['cache'].items():
+            for counter, value in stats.items():
+                if value is None:
+                    continue
+                lines.append(prometheus_sample('etl_dimension_cache', dict(labels, dimension=dimension,
+                                                                           counter=counter), value))
+    lines.append('etl_last_run_timestamp_seconds{{name="{}"}} {}'.format(name, int(now.timestamp())))
+    prom_path = os.path.join(metrics_dir, '{}.prom'.format(name))
+    write_atomic(prom_path, '\n'.join(lines) + '\n')
+    logger.info('run report written to {} and {}'.format(json_path, prom_path))
+    return json_path
+
+
+# function to run a callable under cProfile and save its stats
+def run_profiled(path, function, *args, **kwargs):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
+        logger.info('profile written to {}'.format(path))
+        print('profile written to {}'.format(path))
@@ -1,11 +1,21 @@
 import os, glob
 import importlib
+import json
+
+# manifest of the objects of dw_object_folder, rebuilt when a folder is added or removed
+REGISTRY_FILE = '.object_registry.json'
+OBJECT_TYPES = ['dimension', 'fact']
+# objects that are never run by the etl
+INACTIVE_OBJECTS = ['dim_datetime', 'dim_company']
 
 
 class GetObjects:
-    # get the code of company
+    def __init__(self, company_code=None):
+        self.company_code = company_code
+
+    # get the code of company, the environment is only a fallback for standalone use
     def get_company_code(self):
-        return os.getenv('SRC_COMPANY_CODE')
+        return self.company_code or os.getenv('SRC_COMPANY_CODE')
 
     # get dirpath
     def get_dir_path(self):
@@ -55,46 +65,130 @@ class GetObjects:
             'dw_object_folder.{}.{}.factory'.format(object_type, folder_name))
         return transform, factory
 
-    # get object of each object
-    def get_dictionary_object(self, object_type, transform, factory, folder_path, folder_name):
-        if folder_name in ['dim_datetime', 'dim_company']:
-            dictionary_object = {
-                "name": folder_name,
-                "class": getattr(transform, self.snake_to_camel(folder_name)),
-                "source_sql": self.get_source_name(folder_path, object_type),
-                "create_sql": self.get_create_name(folder_path),
-                "{}_handler".format(object_type): getattr(factory, 'pygram_{}_factory'.format(folder_name)),
-                "etl_active": False,
-            }
-
+    # get object of each object, its modules and sql are loaded when first used
+    def get_dictionary_object(self, object_type, entry):
+        return RegistryObject(self, object_type, os.path.join(self.get_dir_path(), entry['folder_path']),
+                              entry['name'], entry['etl_active'])
 
-        else:
-            dictionary_object = {
-                "name": folder_name,
-                "class": getattr(transform, self.snake_to_camel(folder_name)),
-                "source_sql": self.get_source_name(folder_path, object_type),
-                "create_sql": self.get_create_name(folder_path),
-                "{}_handler".format(object_type): getattr(factory, 'pygram_{}_factory'.format(folder_name)),
-                "etl_active": True,
-            }
-        return dictionary_object
+    # get object of one folder by its name, None if not exist
+    def get_object(self, object_type, object_name):
+        entry = load_registry(self.get_dir_path())['objects'][object_type].get(object_name)
+        if entry is None:
+            return None
+        return self.get_dictionary_object(object_type, entry)
 
     # run_class_function
     def get_objects(self, object_type):
         object_configs = []
+        for object_name, entry in sorted(load_registry(self.get_dir_path())['objects'][object_type].items()):
+            if self.get_company_code() in entry['companies']:
+                object_configs.append(self.get_dictionary_object(object_type, entry))
+        return object_configs
 
-        for folder_path in glob.glob(os.path.join(self.get_dir_path(), 'dw_object_folder', object_type, '*')):
-            if self.get_folder_name(folder_path) != '__pycache__':
-                for company in glob.glob(
-                        os.path.join(self.get_dir_path(), 'dw_object_folder', object_type,
-                                     self.get_folder_name(folder_path),
-                                     'sql',
-                                     'creates_folder', '*')):
-                    if self.get_folder_name(company) == self.get_company_code():
-                        transform, factory = self.get_transform_and_factory(object_type,
-                                                                            self.get_folder_name(folder_path))
-                        new_dictionary = self.get_dictionary_object(object_type, transform, factory, folder_path,
-                                                                    self.get_folder_name(folder_path))
-                        object_configs.append(new_dictionary)
 
-        return object_configs
+class RegistryObject(dict):
+    """Object of the registry, with name and etl_active set.
+
+    The transform class, the factory and the sql are loaded the first time
+    one of them is read, so objects that do not run import nothing.
+    """
+
+    def __init__(self, objects, object_type, folder_path, name, etl_active):
+        super().__init__(name=name, etl_active=etl_active)
+        self.objects = objects
+        self.object_type = object_type
+        self.folder_path = folder_path
+
+    def __missing__(self, key):
+        handler = '{}_handler'.format(self.object_type)
+        if key in ('class', handler):
+            transform, factory = self.objects.get_transform_and_factory(self.object_type, self['name'])
+            self['class'] = getattr(transform, self.objects.snake_to_camel(self['name']))
+            self[handler] = getattr(factory, 'pygram_{}_factory'.format(self['name']))
+        elif key == 'source_sql':
+            self['source_sql'] = self.objects.get_source_name(self.folder_path, self.object_type)
+        elif key == 'create_sql':
+            self['create_sql'] = self.objects.get_create_name(self.folder_path)
+        else:
+            raise KeyError(key)
+        return self[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+# function to get the folders whose mtime invalidates the registry: adding or removing an object or a company
+# changes the mtime of its parent folder
+def get_registry_folders(dir_path):
+    folders = []
+    for object_type in OBJECT_TYPES:
+        type_path = os.path.join(dir_path, 'dw_object_folder', object_type)
+        folders.append(type_path)
+        for folder_path in glob.glob(os.path.join(type_path, '*')):
+            if os.path.basename(folder_path) != '__pycache__':
+                folders += [folder_path, os.path.join(folder_path, 'sql', 'creates_folder')]
+    return folders
+
+
+# function to get the mtime of each registry folder, None when it does not exist
+def get_folder_mtimes(dir_path, folders):
+    mtimes = {}
+    for folder in folders:
+        try:
+            mtimes[os.path.relpath(folder, dir_path)] = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtimes[os.path.relpath(folder, dir_path)] = None
+    return mtimes
+
+
+# function to scan dw_object_folder into a registry of object names, folders, companies and etl_active
+def build_registry(dir_path):
+    folders = get_registry_folders(dir_path)
+    registry = {'mtimes': get_folder_mtimes(dir_path, folders), 'objects': {}}
+    for object_type in OBJECT_TYPES:
+        registry['objects'][object_type] = {}
+        for folder_path in glob.glob(os.path.join(dir_path, 'dw_object_folder', object_type, '*')):
+            folder_name = os.path.basename(folder_path)
+            if folder_name == '__pycache__' or not os.path.isdir(folder_path):
+                continue
+            registry['objects'][object_type][folder_name] = {
+                'name': folder_name,
+                'folder_path': os.path.relpath(folder_path, dir_path),
+                # objects are active for the companies having a create sql folder
+                'companies': sorted(os.path.basename(company) for company in glob.glob(
+                    os.path.join(folder_path, 'sql', 'creates_folder', '*'))),
+                'etl_active': folder_name not in INACTIVE_OBJECTS,
+            }
+    return registry
+
+
+# function to load the registry manifest, rebuilt when a registry folder changed since it was written
+def load_registry(dir_path, registry_file=REGISTRY_FILE):
+    path = os.path.join(dir_path, registry_file)
+    try:
+        with open(path) as f:
+            registry = json.load(f)
+        mtimes = registry['mtimes']
+        if get_folder_mtimes(dir_path, [os.path.join(dir_path, folder) for folder in mtimes]) == mtimes:
+            return registry
+    except (OSError, ValueError, KeyError):
+        pass
+    registry = build_registry(dir_path)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return registry
+
+
+# function to print the objects of the registry, without importing them
+def list_objects(dir_path=None):
+    registry = load_registry(dir_path or os.getcwd())
+    for object_type in OBJECT_TYPES:
+        for object_name, entry in sorted(registry['objects'][object_type].items()):
+            print('{:<10} {:<40} {:<8} {}'.format(object_type, object_name,
+                                                  'active' if entry['etl_active'] else 'inactive',
+                                                  ','.join(entry['companies'])))
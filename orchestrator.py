@@ -0,0 +1,133 @@
+import datetime
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from config import connect_source, connect_dw, get_dw_target
+from etl import load_dimensions, run_dimension_object, run_fact_object
+from scheduler import print_report
+from dw_object_folder.objects import GetObjects
+from reporting import configure_logging, get_log_level
+from rollups import check_rollups
+
+logger = logging.getLogger(__name__)
+
+
+# function to get company codes from comma separated yaml files, or from every yaml file of the folder
+def get_company_codes(company_yaml, all_configs=False):
+    if all_configs:
+        return sorted(os.path.basename(path)[:-5] for path in glob.glob(os.path.join(os.getcwd(), '*.yaml')))
+    return [config.strip()[:-5] for config in company_yaml.split(',') if config.strip()]
+
+
+# function to get the active objects of a company, optionally only one of them
+def get_active_objects(company_code, object_type, object_name=None):
+    return [o for o in GetObjects(company_code).get_objects(object_type)
+            if o["etl_active"] and (not object_name or o['name'] == object_name)]
+
+
+# function to compare the rollups of the active facts of a company with a full recompute
+def check_company_rollups(company_code, object_name=None):
+    """Return the number of rollup rows that differ from a full recompute."""
+    dw_pgconn = connect_dw(company_code)
+    differing = 0
+    try:
+        for o in get_active_objects(company_code, 'fact', object_name):
+            for rollup_name, count in check_rollups(dw_pgconn, o['name'], o['fact_handler']).items():
+                status = 'ok' if not count else '{} rows differ'.format(count)
+                logger.info('{} rollup {} of {}: {}'.format(company_code, rollup_name, o['name'], status))
+                print('{} rollup {} of {}: {}'.format(company_code, rollup_name, o['name'], status))
+                differing += count
+    finally:
+        dw_pgconn.close()
+    return differing
+
+
+# function to run objects one after another on the given connections and collect their status
+def run_objects(company_code, object_type, object_configs, src_pgconn, dw_pgconn, etl_options,
+                list_dimensions=None):
+    options = dict(etl_options, company_code=company_code)
+    results = []
+    for o in object_configs:
+        start = time.time()
+        result = {'name': '{}.{}'.format(company_code, o['name']), 'type': object_type,
+                  'company_code': company_code, 'status': 'done', 'rows': 0, 'error': ''}
+        try:
+            if object_type == 'dimension':
+                result['metrics'] = run_dimension_object(o, src_pgconn, dw_pgconn, options)
+            else:
+                result['metrics'] = run_fact_object(o, src_pgconn, dw_pgconn, list_dimensions, options)
+            result['rows'] = result['metrics']['rows']
+        except Exception as e:
+            dw_pgconn.rollback()
+            logger.exception('{} of {} failed'.format(o['name'], company_code))
+            result['status'] = 'failed'
+            result['error'] = '{}: {}'.format(e.__class__.__name__, e)
+        result['seconds'] = round(time.time() - start, 1)
+        results.append(result)
+    return results
+
+
+# function run in a worker process: every dimension of one company
+def run_company_dimensions(company_code, etl_options, object_name=None):
+    src_pgconn, dw_pgconn = connect_source(company_code), connect_dw(company_code)
+    try:
+        return run_objects(company_code, 'dimension', get_active_objects(company_code, 'dimension', object_name),
+                           src_pgconn, dw_pgconn, etl_options)
+    finally:
+        src_pgconn.close()
+        dw_pgconn.close()
+
+
+# function run in a worker process: every fact of the companies loading into one dw,
+# the dimension caches are loaded once and shared by all of them
+def run_dw_facts(company_codes, etl_options, object_name=None):
+    dw_pgconn = connect_dw(company_codes[0])
+    list_dimensions = load_dimensions(dw_pgconn)
+    results = []
+    try:
+        for company_code in company_codes:
+            src_pgconn = connect_source(company_code)
+            try:
+                results += run_objects(company_code, 'fact', get_active_objects(company_code, 'fact', object_name),
+                                       src_pgconn, dw_pgconn, etl_options, list_dimensions)
+            finally:
+                src_pgconn.close()
+    finally:
+        dw_pgconn.close()
+    return results
+
+
+# function to run several companies in one process pool
+def run_companies(company_codes, run_dimensions, run_facts, workers, etl_options, object_name=None):
+    """
+    Dimensions of all companies run concurrently first (writers of the same
+    dimension table wait for each other). Facts then run concurrently per
+    data warehouse, companies of the same dw share one set of dimension caches.
+    """
+    print('current time is {}'.format(datetime.datetime.now()))
+    if object_name:
+        run_dimensions = object_name[:3] == 'dim'
+        run_facts = object_name[:4] == 'fact'
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=configure_logging,
+                             initargs=(get_log_level(),)) as executor:
+        if run_dimensions:
+            futures = [executor.submit(run_company_dimensions, company_code, etl_options, object_name)
+                       for company_code in company_codes]
+            for future in futures:
+                results += future.result()
+
+        if run_facts:
+            dw_groups = {}
+            for company_code in company_codes:
+                dw_groups.setdefault(get_dw_target(company_code), []).append(company_code)
+            futures = [executor.submit(run_dw_facts, group, etl_options, object_name)
+                       for group in dw_groups.values()]
+            for future in futures:
+                results += future.result()
+
+    print_report(', '.join(company_codes), results)
+    return results
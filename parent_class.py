@@ -1,10 +1,18 @@
 import os, glob
 import datetime
+import columnar
 
 class TransformBase:
+    # company code set by the etl, the environment is only a fallback for standalone use
+    company_code = None
+
+    # helpers applied to each chunk of rows with the batch api instead of per row,
+    # for example ('round_time', 'add_config_name'). Subclasses that opt in stop calling them per row.
+    batch_steps = ()
+
     # get the code of company
     def get_company_code(self):
-        return os.getenv('SRC_COMPANY_CODE')
+        return self.company_code or os.getenv('SRC_COMPANY_CODE')
 
     # get the name of current class
     def getName(self):
@@ -46,4 +54,34 @@ class TransformBase:
             row['period_month'] = int(row['period_name'][:-5])
         else:
             row['period_year'] = None
-            row['period_month'] = None
\ No newline at end of file
+            row['period_month'] = None
+
+    # apply the batch_steps to a chunk of rows at once
+    def apply_batch(self, rows):
+        columns = columnar.ColumnBatch(rows)
+        for step in self.batch_steps:
+            getattr(self, '{}_batch'.format(step))(columns)
+        columns.write_back()
+
+    # batch version of add_config_name
+    def add_config_name_batch(self, columns):
+        lookup_name = self.getName()[3:].lower()
+        company_code = self.get_company_code()
+        columns['lookup_{}'.format(lookup_name)] = columnar.lookup_keys(columns['initial_id'], company_code)
+        columns['company_code'] = columnar.np.full(len(columns.rows), company_code, dtype=object)
+
+    # batch version of round_time
+    def round_time_batch(self, columns):
+        columns['epoch'] = columnar.round_time(columns['date'])
+
+    # batch version of datetime_to_epoch
+    def datetime_to_epoch_batch(self, columns):
+        columns['date_epoch'] = columnar.datetime_to_epoch(columns['date'])
+
+    # batch version of date_to_epoch
+    def date_to_epoch_batch(self, columns):
+        columns['epoch'] = columnar.date_to_epoch(columns['date'])
+
+    # batch version of add_month_and_year
+    def add_month_and_year_batch(self, columns):
+        columns['period_year'], columns['period_month'] = columnar.period_year_and_month(columns['period_name'])
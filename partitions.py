@@ -0,0 +1,185 @@
+import datetime
+import logging
+from control import lock_object
+from datetime_dimension import DATETIME_BASE_EPOCH, DATETIME_STEP, datetime_key
+
+logger = logging.getLogger(__name__)
+
+
+# function to get the partition columns of a 'partition' spec, 'datetime_id' or ['period_year', 'period_month']
+def get_partition_columns(spec):
+    key = spec['key']
+    return [key] if isinstance(key, str) else list(key)
+
+
+# function to parse a period given as YYYY-MM
+def parse_period(period):
+    year, month = period.split('-')
+    return int(year), int(month)
+
+
+# function to get the month after a period
+def next_period(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+# function to name the partition of a period
+def get_partition_name(table, year, month):
+    return '{}_p{:04d}{:02d}'.format(table, year, month)
+
+
+# function to name the default partition, which holds the rows whose partition columns are NULL
+def get_default_partition_name(table):
+    return '{}_pdefault'.format(table)
+
+
+# function to get the lower and upper bound of the partition of a period, as tuples of partition column values
+def get_period_bounds(spec, year, month):
+    upper = next_period(year, month)
+    if get_partition_columns(spec) == ['datetime_id']:
+        return ((datetime_key(int(datetime.datetime(year, month, 1).timestamp())),),
+                (datetime_key(int(datetime.datetime(upper[0], upper[1], 1).timestamp())),))
+    return (year, month), upper
+
+
+# function to get the period of a fact row from its partition columns, None when one of them is NULL
+def get_row_period(spec, row):
+    columns = get_partition_columns(spec)
+    if any(row[column] is None for column in columns):
+        return None
+    if columns == ['datetime_id']:
+        dt = datetime.datetime.fromtimestamp(DATETIME_BASE_EPOCH + (row['datetime_id'] - 1) * DATETIME_STEP)
+        return dt.year, dt.month
+    return row[columns[0]], row[columns[1]]
+
+
+# function to turn the create_sql of a fact into the creation of a range-partitioned table
+def get_partitioned_create_sql(create_sql, spec):
+    return '{} PARTITION BY RANGE ({})'.format(create_sql.strip().rstrip(';'), ', '.join(get_partition_columns(spec)))
+
+
+# function to check that a source query can be restricted to a replaced period
+def check_period_placeholder(source_sql, period):
+    if period and '{period}' not in source_sql:
+        raise ValueError('the source query has no {{period}} placeholder, period {} cannot be replaced'.format(period))
+
+
+# function to replace the {period} placeholder of a source query, TRUE when no period is replaced
+def render_period(source_conn, source_sql, period_column, period):
+    check_period_placeholder(source_sql, period)
+    if '{period}' not in source_sql:
+        return source_sql
+    if not period:
+        return source_sql.replace('{period}', 'TRUE')
+    if not period_column:
+        raise ValueError("the source query has a {period} placeholder but the factory has no 'period_column'")
+    year, month = parse_period(period)
+    upper = next_period(year, month)
+    cursor = source_conn.cursor()
+    predicate = cursor.mogrify('{} >= %s AND {} < %s'.format(period_column, period_column),
+                               (datetime.date(year, month, 1), datetime.date(upper[0], upper[1], 1))).decode('utf8')
+    cursor.close()
+    return source_sql.replace('{period}', predicate)
+
+
+class PartitionManager:
+    """Create the monthly range partitions of a fact table as rows of new periods arrive.
+
+    The known partitions are read from the catalog once. Rows whose partition
+    columns are NULL go to a DEFAULT partition, created with the first of them.
+    A table created before its factory declared a partition is not partitioned,
+    rows are then loaded into it as before.
+    """
+
+    def __init__(self, output_conn, table, spec):
+        self.output_conn = output_conn
+        self.table = table
+        self.spec = spec
+        cursor = output_conn.cursor()
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))',
+                       (table,))
+        self.enabled = cursor.fetchone()[0]
+        cursor.execute('''SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                          WHERE i.inhparent = to_regclass(%s)''', (table,))
+        self.partitions = set(name for name, in cursor.fetchall())
+        cursor.close()
+        if not self.enabled:
+            logger.warning('{} is not a partitioned table, it is loaded without partitions'.format(table))
+
+    def bounds_sql(self, year, month):
+        lower, upper = get_period_bounds(self.spec, year, month)
+        cursor = self.output_conn.cursor()
+        bounds = cursor.mogrify('FROM ({}) TO ({})'.format(', '.join(['%s'] * len(lower)),
+                                                           ', '.join(['%s'] * len(upper))),
+                                lower + upper).decode('utf8')
+        cursor.close()
+        return bounds
+
+    def create(self, year, month):
+        name = get_partition_name(self.table, year, month)
+        # concurrent loads of the same fact may reach a new period together
+        lock_object(self.output_conn, name)
+        cursor = self.output_conn.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES {}'.format(
+            name, self.table, self.bounds_sql(year, month)))
+        cursor.close()
+        self.partitions.add(name)
+        logger.info('partition {} created'.format(name))
+
+    def create_default(self):
+        name = get_default_partition_name(self.table)
+        lock_object(self.output_conn, name)
+        cursor = self.output_conn.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT'.format(name, self.table))
+        cursor.close()
+        self.partitions.add(name)
+        logger.info('partition {} created'.format(name))
+
+    # function to create the partitions of the periods of a chunk of rows
+    def ensure(self, rows):
+        if not self.enabled:
+            return
+        for period in set(get_row_period(self.spec, row) for row in rows):
+            if period is None:
+                if get_default_partition_name(self.table) not in self.partitions:
+                    self.create_default()
+            elif get_partition_name(self.table, *period) not in self.partitions:
+                self.create(*period)
+
+    # function to create an empty table to load a period into, swapped in by replace
+    def create_period_table(self, period):
+        if not self.enabled:
+            raise ValueError('{} is not a partitioned table, a period cannot be replaced'.format(self.table))
+        year, month = parse_period(period)
+        name = '{}_new'.format(get_partition_name(self.table, year, month))
+        cursor = self.output_conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(name))
+        # with the indexes of the fact the writers can look rows up and ATTACH reuses them
+        cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES)'.format(
+            name, self.table))
+        cursor.close()
+        return name
+
+    # function to swap a loaded period table in place of the partition of the period, in the load transaction
+    def replace(self, period, new_table):
+        year, month = parse_period(period)
+        name = get_partition_name(self.table, year, month)
+        lower, upper = get_period_bounds(self.spec, year, month)
+        columns = get_partition_columns(self.spec)
+        cursor = self.output_conn.cursor()
+        # a CHECK constraint implying the bounds lets ATTACH skip the validation scan of the new table
+        check = cursor.mogrify('({}) >= ({}) AND ({}) < ({})'.format(
+            ', '.join(columns), ', '.join(['%s'] * len(lower)), ', '.join(columns), ', '.join(['%s'] * len(upper))),
+            lower + upper).decode('utf8')
+        cursor.execute('ALTER TABLE {} ADD CONSTRAINT {}_period_check CHECK ({})'.format(new_table, name, check))
+        if name in self.partitions:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(self.table, name))
+            cursor.execute('DROP TABLE {}'.format(name))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(new_table, name))
+        cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES {}'.format(self.table, name,
+                                                                             self.bounds_sql(year, month)))
+        cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}_period_check'.format(name, name))
+        cursor.close()
+        self.partitions.add(name)
+        logger.info('partition {} replaced'.format(name))
+        return name
@@ -0,0 +1,98 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# number of chunks buffered between two stages
+PIPELINE_DEPTH = 4
+
+# marker put on a queue when the stage feeding it is finished
+STAGE_DONE = object()
+
+
+class Pipeline:
+    """Run extract and transform as threads feeding the load loop.
+
+    Stages are connected by bounded queues of row chunks, so a fast stage
+    waits for a slow one (backpressure). The first error of any stage aborts
+    every stage and is raised in the load loop, where the caller rolls back.
+    """
+
+    def __init__(self, depth=PIPELINE_DEPTH):
+        self.depth = depth
+        self.abort = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.abort.set()
+
+    def put(self, stage_queue, item):
+        while not self.abort.is_set():
+            try:
+                stage_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue):
+        while True:
+            try:
+                return stage_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise self.error or RuntimeError('pipeline aborted')
+
+    # rows of the chunks of a queue, used as the input of the next stage
+    def iter_rows(self, stage_queue):
+        while True:
+            chunk = self.get(stage_queue)
+            if chunk is STAGE_DONE:
+                return
+            for row in chunk:
+                yield row
+
+    def run_stage(self, name, rows, out_queue, chunk_size):
+        # imported here because etl imports this module
+        from etl import iter_chunks
+        try:
+            for chunk in iter_chunks(rows, chunk_size):
+                if not self.put(out_queue, chunk):
+                    return
+            self.put(out_queue, STAGE_DONE)
+        except Exception as e:
+            logger.exception('{} stage failed'.format(name))
+            self.fail(e)
+
+    def start_stage(self, name, rows, chunk_size):
+        out_queue = queue.Queue(maxsize=self.depth)
+        thread = threading.Thread(target=self.run_stage, args=(name, rows, out_queue, chunk_size),
+                                  name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+        return out_queue
+
+    def run(self, data_source, transform, chunk_size):
+        """Yield the transformed chunks, transform is called with the stream of extracted rows."""
+        extracted = self.start_stage('extract', data_source, chunk_size)
+        transformed = self.start_stage('transform', transform(self.iter_rows(extracted)), chunk_size)
+        try:
+            while True:
+                chunk = self.get(transformed)
+                if chunk is STAGE_DONE:
+                    break
+                yield chunk
+        except GeneratorExit:
+            self.abort.set()
+            raise
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self.abort.set()
+            for thread in self.threads:
+                thread.join()
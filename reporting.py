@@ -0,0 +1,122 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = 'etl_process.log'
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(message)s'
+LOG_DATEFMT = '%Y/%m/%d %I:%M:%S %p'
+# seconds between two progress updates on stdout
+PROGRESS_INTERVAL = 1.0
+
+# listener of the current process and the pid it was started in, forked workers start their own
+_listener = None
+_listener_pid = None
+
+
+# rotate log based on time
+def create_timed_rotating_log(path):
+    handler = TimedRotatingFileHandler(path, when="MIDNIGHT", interval=1, backupCount=5)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    return handler
+
+
+# function to send log records through a queue, the file is written by a listener thread
+def configure_logging(level=logging.INFO, log_file=LOG_FILE):
+    """Log to the rotating file without blocking the caller on disk writes.
+
+    Call it once per process, process pools call it as their initializer:
+    the listener thread of the parent does not survive a fork.
+    """
+    global _listener, _listener_pid
+    if isinstance(level, str):
+        level = getattr(logging, level.upper())
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener_pid == os.getpid():
+        return _listener
+
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    records = queue.Queue(-1)
+    root.addHandler(QueueHandler(records))
+    _listener = QueueListener(records, create_timed_rotating_log(log_file), respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+# function to get the level of the root logger, passed to the initializer of worker processes
+def get_log_level():
+    return logging.getLogger().level
+
+
+class RowTracer:
+    """Sampled debug trace of the rows of a load loop.
+
+    trace_rows is 0 (off), 'failed' (only the row that raised) or N (every Nth
+    row and the row that raised). The load loop checks every itself, so an
+    untraced row costs one integer test.
+    """
+
+    def __init__(self, object_name, fields, trace_rows=0):
+        self.object_name = object_name
+        self.fields = fields
+        self.failed_rows = bool(trace_rows)
+        self.every = 0
+        if trace_rows and trace_rows != 'failed':
+            self.every = int(trace_rows)
+        # nothing is formatted when the records would be dropped anyway
+        if not logger.isEnabledFor(logging.DEBUG):
+            self.every = 0
+
+    def describe(self, row):
+        return dict((field, row.get(field)) for field in self.fields)
+
+    def trace(self, count, row):
+        logger.debug('{} row {}:{}'.format(self.object_name, count, self.describe(row)))
+
+    def failed(self, count, row, error):
+        if self.failed_rows and row is not None:
+            logger.error('{} row {} failed with {}: {}'.format(self.object_name, count, error, self.describe(row)))
+
+
+# function to draw the progress bar, an open-ended counter when the size of the source is unknown
+def progress(count, total, status=''):
+    if not total:
+        sys.stdout.write('{} rows {}\r'.format(count, status))
+        sys.stdout.flush()
+        return
+    bar_len = 50
+    filled_len = int(round(bar_len * count / float(total)))
+    percents = round(100.0 * count / float(total), 1)
+    bar = '=' * filled_len + '-' * (bar_len - filled_len)
+    sys.stdout.write('{} {}% {}/{} {}\r'.format(bar, percents, count, total, status))
+    sys.stdout.flush()
+
+
+class Progress:
+    """Progress on stdout written at most once per interval seconds, 0 turns it off."""
+
+    def __init__(self, total, status='', interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.status = status
+        self.interval = interval
+        self.next_update = time.monotonic() + interval if interval else float('inf')
+
+    def update(self, count):
+        now = time.monotonic()
+        if now >= self.next_update:
+            self.next_update = now + self.interval
+            progress(count, self.total, self.status)
+
+    def done(self, count):
+        if self.interval:
+            progress(count, self.total, self.status)
+            sys.stdout.write('\n')
@@ -0,0 +1,152 @@
+import logging
+from bulk import copy_rows, create_staging_table
+from control import lock_object
+from ddl import ensure_table
+
+logger = logging.getLogger(__name__)
+
+# aggregates that can be maintained from the inserted rows alone, avg is kept as a sum and a count
+ROLLUP_FUNCTIONS = ['sum', 'count', 'min', 'max']
+
+
+# function to get the rollup definitions of a fact factory, checked against its keyrefs and measures
+def get_rollups(pygram_fact_factory):
+    """
+    Rollups are declared in the fact factory as 'rollups': [{'name': ..., 'group_by': [...],
+    'aggregates': {column: (function, measure), ...}}, ...] where function is sum, count, min
+    or max and measure is a measure of the fact ('*' for count).
+    """
+    columns = list(pygram_fact_factory['keyrefs']) + list(pygram_fact_factory['measures'])
+    rollups = []
+    for rollup in pygram_fact_factory.get('rollups', []):
+        for column in rollup['group_by']:
+            if column not in columns:
+                raise ValueError('group_by column {} of rollup {} is not a keyref or measure'.format(
+                    column, rollup['name']))
+        for column, (function, measure) in rollup['aggregates'].items():
+            if function not in ROLLUP_FUNCTIONS:
+                raise ValueError('aggregate {} of rollup {} is {}, only {} can be maintained incrementally'.format(
+                    column, rollup['name'], function, ', '.join(ROLLUP_FUNCTIONS)))
+            if measure not in columns and not (function == 'count' and measure == '*'):
+                raise ValueError('aggregate {} of rollup {} reads {}, which is not a measure'.format(
+                    column, rollup['name'], measure))
+        rollups.append(rollup)
+    return rollups
+
+
+# function to get the SELECT computing a rollup from a table
+def rollup_select(rollup, table, where=''):
+    aggregates = ['{}({}) AS {}'.format(function, measure, column)
+                  for column, (function, measure) in rollup['aggregates'].items()]
+    return 'SELECT {} FROM {} {} GROUP BY {}'.format(', '.join(rollup['group_by'] + aggregates), table, where,
+                                                     ', '.join(rollup['group_by']))
+
+
+# function to get how a rollup column merges with the aggregate of newly loaded rows
+def merge_sql(rollup_name, column, function):
+    if function in ('min', 'max'):
+        # LEAST and GREATEST ignore NULL, like min and max
+        return '{} = {}({}.{}, EXCLUDED.{})'.format(column, 'LEAST' if function == 'min' else 'GREATEST',
+                                                    rollup_name, column, column)
+    # sum over only NULL measures is NULL, as in a full recompute
+    current = '{}.{}'.format(rollup_name, column)
+    return '{} = CASE WHEN {} IS NULL THEN EXCLUDED.{} WHEN EXCLUDED.{} IS NULL THEN {} ELSE {} + EXCLUDED.{} END'\
+        .format(column, current, column, column, current, current, column)
+
+
+class RollupMaintainer:
+    """Keep the rollup tables of a fact up to date in the load transaction.
+
+    New rollup tables are filled from the whole fact. Afterwards rows inserted
+    by the load are aggregated and merged into the rollups with one
+    INSERT ... ON CONFLICT DO UPDATE per rollup, and the groups of a replaced
+    period are recomputed from the fact. The group_by columns are assumed not
+    NULL, NULL never conflicts in a unique index.
+    """
+
+    def __init__(self, output_conn, fact_name, pygram_fact_factory):
+        self.output_conn = output_conn
+        self.fact_name = fact_name
+        self.rollups = get_rollups(pygram_fact_factory)
+        self.staging = 'stg_rollup_{}'.format(fact_name)
+        self.columns = []
+        for rollup in self.rollups:
+            for column in rollup['group_by'] + [measure for _, measure in rollup['aggregates'].values()]:
+                if column != '*' and column not in self.columns:
+                    self.columns.append(column)
+        self.staged = False
+        self.merged = 0
+
+    # function to create the missing rollup tables, filled from the rows already in the fact
+    def ensure(self):
+        for rollup in self.rollups:
+            lock_object(self.output_conn, rollup['name'])
+            select = rollup_select(rollup, self.fact_name)
+            if ensure_table(self.output_conn, rollup['name'], 'CREATE TABLE {} AS {}'.format(rollup['name'], select)):
+                cursor = self.output_conn.cursor()
+                cursor.execute('CREATE UNIQUE INDEX {}_group_uidx ON {} ({})'.format(
+                    rollup['name'], rollup['name'], ', '.join(rollup['group_by'])))
+                cursor.close()
+                logger.info('rollup {} of {} created'.format(rollup['name'], self.fact_name))
+
+    # function to merge the rows inserted into the fact into every rollup
+    def apply(self, rows):
+        if not self.rollups or not rows:
+            return
+        cursor = self.output_conn.cursor()
+        if not self.staged:
+            create_staging_table(cursor, self.staging, self.fact_name, self.columns)
+            self.staged = True
+        cursor.execute('TRUNCATE {}'.format(self.staging))
+        copy_rows(cursor, self.staging, self.columns, [[row[column] for column in self.columns] for row in rows])
+        for rollup in self.rollups:
+            columns = rollup['group_by'] + list(rollup['aggregates'])
+            cursor.execute('INSERT INTO {} ({}) {} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                rollup['name'], ', '.join(columns), rollup_select(rollup, self.staging),
+                ', '.join(rollup['group_by']),
+                ', '.join(merge_sql(rollup['name'], column, function)
+                          for column, (function, _) in rollup['aggregates'].items())))
+        cursor.close()
+        self.merged += len(rows)
+
+    # function to collect the groups found in tables about to be swapped, before they leave the fact
+    def collect(self, tables):
+        cursor = self.output_conn.cursor()
+        for number, rollup in enumerate(self.rollups):
+            groups = 'stg_rollup_groups_{}'.format(number)
+            cursor.execute('DROP TABLE IF EXISTS pg_temp.{}'.format(groups))
+            cursor.execute('CREATE TEMP TABLE {} AS {}'.format(groups, ' UNION '.join(
+                'SELECT DISTINCT {} FROM {}'.format(', '.join(rollup['group_by']), table) for table in tables)))
+        cursor.close()
+
+    # function to recompute from the fact the groups collected before a swap
+    def recompute(self):
+        cursor = self.output_conn.cursor()
+        for number, rollup in enumerate(self.rollups):
+            groups = 'stg_rollup_groups_{}'.format(number)
+            group_by = ', '.join(rollup['group_by'])
+            cursor.execute('DELETE FROM {} WHERE ({}) IN (SELECT {} FROM {})'.format(rollup['name'], group_by,
+                                                                                   group_by, groups))
+            cursor.execute('INSERT INTO {} ({}) {}'.format(
+                rollup['name'], ', '.join(rollup['group_by'] + list(rollup['aggregates'])),
+                rollup_select(rollup, self.fact_name,
+                              'WHERE ({}) IN (SELECT {} FROM {})'.format(group_by, group_by, groups))))
+            logger.info('rollup {}: {} groups recomputed'.format(rollup['name'], cursor.rowcount))
+            cursor.execute('DROP TABLE {}'.format(groups))
+        cursor.close()
+
+
+# function to compare the rollups of a fact with a full recompute, returns the number of differing rows per rollup
+def check_rollups(output_conn, fact_name, pygram_fact_factory):
+    result = {}
+    cursor = output_conn.cursor()
+    for rollup in get_rollups(pygram_fact_factory):
+        columns = ', '.join(rollup['group_by'] + list(rollup['aggregates']))
+        recompute = rollup_select(rollup, fact_name)
+        cursor.execute('''SELECT COUNT(*) FROM ((SELECT {} FROM {} EXCEPT ALL {})
+                          UNION ALL ({} EXCEPT ALL SELECT {} FROM {})) AS difference'''.format(
+            columns, rollup['name'], recompute, recompute, columns, rollup['name']))
+        result[rollup['name']] = cursor.fetchone()[0]
+    cursor.close()
+    output_conn.rollback()
+    return result
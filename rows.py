@@ -0,0 +1,106 @@
+import sys
+from collections.abc import MutableMapping
+
+# 'dict' keeps the rows of the transform as they are, 'compact' turns them into CompactRow records: less memory
+# per row, but the copy from and back to dicts makes a load slower, so 'dict' is the default
+ROW_MODES = ['dict', 'compact']
+# rows sampled to measure the memory of a row
+ROW_SIZE_SAMPLE = 1000
+
+
+class CompactRow(MutableMapping):
+    """Row of a fixed schema, its values are held in one list indexed by column.
+
+    Subclasses made by make_row_class carry the schema, so a row costs a small
+    object and a list instead of a dict, and keys of the transform outside the
+    schema are dropped. Columns of the schema that are not set read as None,
+    columns outside it raise KeyError like a dict.
+    """
+
+    __slots__ = ('values',)
+    columns = ()
+    index = {}
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        try:
+            return self.values[self.index[key]]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            self.values[self.index[key]] = value
+        except KeyError:
+            raise KeyError('{} is not a column of the row schema'.format(key)) from None
+
+    def __delitem__(self, key):
+        raise TypeError('columns of a compact row cannot be deleted')
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def copy(self):
+        return dict(zip(self.columns, self.values))
+
+    def __repr__(self):
+        return 'CompactRow({})'.format(self.copy())
+
+
+# function to make the CompactRow class of a schema
+def make_row_class(columns):
+    columns = tuple(columns)
+    return type('CompactRow', (CompactRow,), {'__slots__': (), 'columns': columns,
+                                              'index': dict((column, i) for i, column in enumerate(columns))})
+
+
+# function to get the columns of the rows of an object, the ones read by the writer, the lookups and the checkpoint
+def get_row_columns(pygram_factory, extra_columns=()):
+    """
+    Columns are the key, lookupatts and attributes of a dimension or the
+    keyrefs and measures of a fact, then extra_columns (for facts the lookup
+    attributes of their dimensions), the 'checkpoint_key' and the factory
+    'row_columns', a list of other columns the load reads.
+    """
+    columns = []
+    for column in ([pygram_factory.get('key')] + list(pygram_factory.get('lookupatts', [])) +
+                   list(pygram_factory.get('attributes', [])) + list(pygram_factory.get('keyrefs', [])) +
+                   list(pygram_factory.get('measures', [])) + list(extra_columns) +
+                   [pygram_factory.get('checkpoint_key')] + list(pygram_factory.get('row_columns', []))):
+        if column and column not in columns:
+            columns.append(column)
+    return columns
+
+
+# function to turn the dict rows of a transform into compact rows of the given class
+def compact_rows(rows, row_class):
+    columns = row_class.columns
+    for row in rows:
+        yield row_class([row.get(column) for column in columns])
+
+
+# function to get a dict of a row for code that needs one, like pygrametl writers and json
+def as_dict(row):
+    return row if isinstance(row, dict) else row.copy()
+
+
+# function to measure the memory of a row: its container and its values, averaged over the first rows of a chunk
+def row_bytes(rows, sample=ROW_SIZE_SAMPLE):
+    rows = rows[:sample]
+    if not rows:
+        return 0
+    total = 0
+    for row in rows:
+        if isinstance(row, CompactRow):
+            total += sys.getsizeof(row) + sys.getsizeof(row.values) + sum(sys.getsizeof(v) for v in row.values)
+        else:
+            total += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+    return total // len(rows)
@@ -1,132 +1,148 @@
+import logging
 import optparse
-import yaml
-import psycopg2
-import os, glob
-from etl import run_dimension_etl, run_fact_etl, load_dimensions
-from dw_object_folder.objects import GetObjects
+import re
+import sys
+import datetime
+import os
+from config import get_configs, connect_dw
+from etl import load_dimensions, CHUNK_SIZE, ITERSIZE
+from dw_object_folder.objects import GetObjects, list_objects
+from scheduler import run_scheduled, print_report
+from orchestrator import get_company_codes, run_companies, run_objects, check_company_rollups
+from datetime_dimension import generate_datetime_dimension, DATETIME_CREATE_SQL
+from metrics import write_run_report, run_profiled, METRICS_DIR
+from reporting import configure_logging, PROGRESS_INTERVAL
+from rows import ROW_MODES
 
+logger = logging.getLogger(__name__)
 
-# function to get config
-def get_configs(company_code):
-    os.environ['SRC_COMPANY_CODE'] = company_code
 
-    with open('{}.yaml'.format(company_code), 'r') as stream:
-        data_loaded = yaml.safe_load(stream)
-
-        dw_db_host = data_loaded['DW_DB_HOST']
-        dw_db_port = data_loaded['DW_DB_PORT']
-        dw_db_name = data_loaded['DW_DB_NAME']
-        dw_db_user = data_loaded['DW_DB_USER']
-        dw_db_password = data_loaded['DW_DB_PASSWORD']
-
-        src_db_host = data_loaded['SRC_DB_HOST']
-        src_db_port = data_loaded['SRC_DB_PORT']
-        src_db_user = data_loaded['SRC_DB_USER']
-        src_db_password = data_loaded['SRC_DB_PASSWORD']
-        src_db_name = data_loaded['SRC_DB_NAME']
+# function to name the report of a run, runs of other companies or object types do not overwrite it
+def get_report_name(company_codes, run_dimensions, run_facts, object_name=None):
+    parts = ['etl'] + company_codes
+    if object_name:
+        parts.append(object_name)
+    else:
+        parts += (['dimensions'] if run_dimensions else []) + (['facts'] if run_facts else [])
+    return '_'.join(parts)
 
-        src_string = """host='{}' port = '{}' dbname='{}' user='{}' password='{}'""".format(src_db_host,
-                                                                                            src_db_port,
-                                                                                            src_db_name,
-                                                                                            src_db_user,
-                                                                                            src_db_password)
-        src_pgconn = psycopg2.connect(src_string)
 
-        # create connection to new data warehouse
-        dw_string = """host='{}' port = '{}' dbname='{}' user='{}' password='{}'""".format(dw_db_host,
-                                                                                           dw_db_port,
-                                                                                           dw_db_name,
-                                                                                           dw_db_user,
-                                                                                           dw_db_password)
-        dw_pgconn = psycopg2.connect(dw_string)
+# main
+def main(run_dimensions, run_facts, company_yaml, object_name, chunk_size=CHUNK_SIZE, count_rows=False,
+         full_refresh=False, jobs=1, all_configs=False, workers=1, generate_datetime=None, itersize=ITERSIZE,
+         pipelined=False, metrics_dir=METRICS_DIR, profile=False, trace_rows=0, progress_interval=PROGRESS_INTERVAL,
+         reprocess_quarantine=False, checkpoint_rows=0, checkpoint_seconds=0, resume=False, replace_period=None,
+         check_rollups=False, row_mode='dict'):
+    company_codes = get_company_codes(company_yaml or '', all_configs)
+    report_name = get_report_name(company_codes, run_dimensions, run_facts, object_name)
 
-    return src_pgconn, dw_pgconn
+    # populate dim_datetime of every dw for the given date range
+    if generate_datetime:
+        start_date, end_date = [datetime.datetime.strptime(d, '%Y-%m-%d').date()
+                                for d in generate_datetime.split(':')]
+        for company_code in company_codes:
+            # a missing dim_datetime is created with the create_sql of its dw object, when there is one
+            datetime_object = GetObjects(company_code).get_object('dimension', 'dim_datetime')
+            create_sql = (datetime_object.get('create_sql') if datetime_object else None) or DATETIME_CREATE_SQL
+            dw_pgconn = connect_dw(company_code)
+            generate_datetime_dimension(dw_pgconn, start_date, end_date, create_sql=create_sql)
+            dw_pgconn.close()
 
+    # compare the rollups with a full recompute instead of running the etl, exit with 1 when they differ
+    if check_rollups:
+        differing = sum(check_company_rollups(company_code, object_name) for company_code in company_codes)
+        sys.exit(1 if differing else 0)
 
-# run_object_class
-run_class = GetObjects()
+    etl_options = {
+        'chunk_size': chunk_size,
+        'count_rows': count_rows,
+        'full_refresh': full_refresh,
+        'itersize': itersize,
+        'pipelined': pipelined,
+        'trace_rows': trace_rows,
+        'progress_interval': progress_interval,
+        'checkpoint_rows': checkpoint_rows,
+        'checkpoint_seconds': checkpoint_seconds,
+        'resume': resume,
+        'row_mode': row_mode,
+    }
+    # only facts have quarantined rows, they are loaded without reading the source
+    if reprocess_quarantine:
+        run_dimensions, run_facts = False, True
+        etl_options['reprocess_quarantine'] = True
+    # one period of a partitioned fact is loaded again and swapped in
+    if replace_period:
+        run_dimensions, run_facts = False, True
+        etl_options['replace_period'] = replace_period
 
+    # several companies run in one process pool
+    if len(company_codes) > 1:
+        # the workers already run in a process pool, objects of one company run one after another
+        if jobs > 1:
+            logger.warning('--jobs is ignored with several companies, --workers {} companies run at once'.format(
+                workers))
+            print('--jobs is ignored with several companies, --workers {} companies run at once'.format(workers))
+        results = run_companies(company_codes, run_dimensions, run_facts, workers, etl_options, object_name)
+        write_run_report(results, metrics_dir, report_name)
+        return results
 
-# main
-def main(run_dimensions, run_facts, company_yaml, object_name):
-    if company_yaml:
-        src_pgconn, dw_pgconn = get_configs(company_yaml[:-5])
+    company_code = company_codes[0]
+    src_pgconn, dw_pgconn = get_configs(company_code)
+    # run_object_class
+    run_class = GetObjects(company_code)
+    etl_options['company_code'] = company_code
 
     if object_name:
-        if object_name[:3] == 'dim':
-            object_type = 'dimension'
-            for folder_path in glob.glob(os.path.join(os.getcwd(), 'dw_object_folder', object_type, '*')):
-                if run_class.get_folder_name(folder_path) == object_name:
-
-                    transform, factory = run_class.get_transform_and_factory(object_type,object_name)
-                    d = run_class.get_dictionary_object(object_type, transform, factory, folder_path,
-                                                                        object_name)
-                    try:
-                        run_dimension_etl(dimension_name=d['name'],
-                                          class_name=d['class'],
-                                          pygram_dimension_factory=d["dimension_handler"],
-                                          source_conn=src_pgconn,
-                                          output_conn=dw_pgconn,
-                                          source_sql=d["source_sql"],
-                                          create_sql=d["create_sql"])
-                    except ValueError:
-                        pass
-
-        if object_name[:4] == 'fact':
-            list_dimensions = load_dimensions(dw_pgconn)
-            object_type = 'fact'
-            for folder_path in glob.glob(os.path.join(os.getcwd(), 'dw_object_folder', object_type, '*')):
-                if run_class.get_folder_name(folder_path) == object_name:
-                    transform, factory = run_class.get_transform_and_factory(object_type, object_name)
-                    f = run_class.get_dictionary_object(object_type, transform, factory, folder_path,
-                                                                        object_name)
-                    try:
-                        run_fact_etl(fact_name=f['name'],
-                                     class_name=f['class'],
-                                     pygram_fact_factory=f["fact_handler"],
-                                     source_conn=src_pgconn,
-                                     output_conn=dw_pgconn,
-                                     source_sql=f["source_sql"],
-                                     create_sql=f["create_sql"],
-                                     dimensions=list_dimensions)
-                    except ValueError:
-                        pass
+        results = []
+        for object_type in ['dimension', 'fact']:
+            o = run_class.get_object(object_type, object_name)
+            if not o:
+                continue
+            list_dimensions = load_dimensions(dw_pgconn) if object_type == 'fact' else None
+            if profile:
+                # profile of the whole object run, open it with pstats or snakeviz
+                results += run_profiled(os.path.join(metrics_dir, '{}.prof'.format(report_name)), run_objects,
+                                        company_code, object_type, [o], src_pgconn, dw_pgconn, etl_options,
+                                        list_dimensions)
+            else:
+                results += run_objects(company_code, object_type, [o], src_pgconn, dw_pgconn, etl_options,
+                                       list_dimensions)
+        print_report(company_code, results)
+        write_run_report(results, metrics_dir, report_name)
+        return results
+
+    # run dimensions and facts with the dependency-aware scheduler on a process pool
+    if jobs > 1 and (run_dimensions or run_facts):
+        object_configs = []
+        if run_dimensions:
+            object_configs += [('dimension', d) for d in run_class.get_objects('dimension') if d["etl_active"]]
+        if run_facts:
+            object_configs += [('fact', f) for f in run_class.get_objects('fact') if f["etl_active"]]
+        results = run_scheduled(etl_options['company_code'], object_configs, jobs, etl_options)
+        write_run_report(results, metrics_dir, report_name)
+        return results
 
+    results = []
     # If run_dimensions
     if run_dimensions:
-        dimension_configs = run_class.get_objects('dimension')
-
-        for d in dimension_configs:
-            if d["etl_active"]:
-                try:
-                    run_dimension_etl(dimension_name=d['name'],
-                                      class_name=d['class'],
-                                      pygram_dimension_factory=d["dimension_handler"],
-                                      source_conn=src_pgconn,
-                                      output_conn=dw_pgconn,
-                                      source_sql=d["source_sql"],
-                                      create_sql=d["create_sql"])
-                except ValueError:
-                    pass
+        dimension_configs = [d for d in run_class.get_objects('dimension') if d["etl_active"]]
+        results += run_objects(company_code, 'dimension', dimension_configs, src_pgconn, dw_pgconn, etl_options)
 
     # If run_facts
     if run_facts:
-        fact_configs = run_class.get_objects('fact')
+        fact_configs = [f for f in run_class.get_objects('fact') if f["etl_active"]]
         list_dimensions = load_dimensions(dw_pgconn)
+        results += run_objects(company_code, 'fact', fact_configs, src_pgconn, dw_pgconn, etl_options,
+                               list_dimensions)
+
+    print_report(company_code, results)
+    write_run_report(results, metrics_dir, report_name)
+    return results
+
 
-        for f in fact_configs:
-            if f["etl_active"]:
-                try:
-                    run_fact_etl(fact_name=f['name'],
-                                 class_name=f['class'],
-                                 pygram_fact_factory=f["fact_handler"],
-                                 source_conn=src_pgconn,
-                                 output_conn=dw_pgconn,
-                                 source_sql=f["source_sql"],
-                                 create_sql=f["create_sql"],
-                                 dimensions=list_dimensions)
-                except ValueError:
-                    pass
+# function to get the exit status of a run, 1 when any object failed
+def get_exit_status(results):
+    return 1 if any(result['status'] == 'failed' for result in results) else 0
 
 
 if __name__ == "__main__":
@@ -139,10 +155,108 @@ if __name__ == "__main__":
                       default=False, help="Run all active fact ETLs")
 
     parser.add_option("-c", "--configs", action="store", type="string", dest="company_yaml",
-                      help='get config from company')
+                      help='get config from company, several companies are separated by comma')
+
+    parser.add_option('--all-configs', action='store_true', dest='all_configs', default=False,
+                      help='run every company yaml of the folder')
+
+    parser.add_option('-w', '--workers', action='store', type='int', dest='workers', default=1,
+                      help='number of companies run at the same time')
 
     parser.add_option('-o', '--object', action='store', type='string', dest='object_name',
                       help='run only this file name')
 
+    parser.add_option('--chunk-size', action='store', type='int', dest='chunk_size', default=CHUNK_SIZE,
+                      help='number of rows held in memory between source and target')
+
+    parser.add_option('--count-rows', action='store_true', dest='count_rows', default=False,
+                      help='run a COUNT(*) pre-query to show a progress bar instead of an open-ended counter')
+
+    parser.add_option('--full-refresh', action='store_true', dest='full_refresh', default=False,
+                      help='ignore stored watermarks and extract the full source')
+
+    parser.add_option('-j', '--jobs', action='store', type='int', dest='jobs', default=1,
+                      help='number of objects of one company run at the same time, facts wait for the dimensions '
+                           'of their keyrefs; ignored with several companies, use --workers')
+
+    parser.add_option('--itersize', action='store', type='int', dest='itersize', default=ITERSIZE,
+                      help='rows fetched per round trip by each partition of a partitioned extract')
+
+    parser.add_option('--pipelined', action='store_true', dest='pipelined', default=False,
+                      help='run extract, transform and load as concurrent stages')
+
+    parser.add_option('--generate-datetime', action='store', type='string', dest='generate_datetime',
+                      help='populate dim_datetime from START to END (exclusive), as YYYY-MM-DD:YYYY-MM-DD')
+
+    parser.add_option('--metrics-dir', action='store', type='string', dest='metrics_dir', default=METRICS_DIR,
+                      help='folder of the json run report and the prometheus textfile')
+
+    parser.add_option('--profile', action='store_true', dest='profile', default=False,
+                      help='run the --object under cProfile and save its stats in the metrics folder')
+
+    parser.add_option('--log-level', action='store', type='choice', dest='log_level', default='INFO',
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='level of etl_process.log')
+
+    parser.add_option('--trace-rows', action='store', type='string', dest='trace_rows', default='0',
+                      help="log every Nth loaded row at DEBUG, or 'failed' to log only the row that failed")
+
+    parser.add_option('--progress-interval', action='store', type='float', dest='progress_interval',
+                      default=PROGRESS_INTERVAL, help='seconds between progress updates, 0 turns progress off')
+
+    parser.add_option('--reprocess-quarantine', action='store_true', dest='reprocess_quarantine', default=False,
+                      help='load the quarantined rows of the facts again instead of extracting the source')
+
+    parser.add_option('--checkpoint-rows', action='store', type='int', dest='checkpoint_rows', default=0,
+                      help="commit a checkpoint every N rows of objects with a 'checkpoint_key' in their factory")
+
+    parser.add_option('--checkpoint-seconds', action='store', type='float', dest='checkpoint_seconds', default=0,
+                      help='commit a checkpoint every T seconds')
+
+    parser.add_option('--resume', action='store_true', dest='resume', default=False,
+                      help='continue interrupted objects after their last checkpoint instead of starting over')
+
+    parser.add_option('--replace-period', action='store', type='string', dest='replace_period', default=None,
+                      help='reload the YYYY-MM period of the partitioned fact --object and swap its partition')
+
+    parser.add_option('--check-rollups', action='store_true', dest='check_rollups', default=False,
+                      help='compare the rollups of the facts with a full recompute instead of running the etl')
+
+    parser.add_option('--row-mode', action='store', type='choice', dest='row_mode', default='dict',
+                      choices=ROW_MODES, help="'compact' turns transformed rows into fixed-schema records, less "
+                                              "memory per row but fewer rows per second, 'dict' (default) is faster")
+
+    parser.add_option('--list-objects', action='store_true', dest='list_objects', default=False,
+                      help='print the objects of the registry and exit')
+
     options, args = parser.parse_args()
-    main(options.run_dimensions, options.run_facts, options.company_yaml, options.object_name)
+    if options.list_objects:
+        list_objects()
+        sys.exit(0)
+    if not options.company_yaml and not options.all_configs:
+        parser.error('--configs or --all-configs is required')
+    if options.profile and not options.object_name:
+        parser.error('--profile needs --object')
+    if options.trace_rows != 'failed' and not options.trace_rows.isdigit():
+        parser.error("--trace-rows must be a number or 'failed'")
+    if options.reprocess_quarantine and (options.run_dimensions or (options.object_name or '')[:3] == 'dim'):
+        parser.error('--reprocess-quarantine only runs facts')
+    if options.replace_period:
+        if (options.object_name or '')[:4] != 'fact':
+            parser.error('--replace-period needs a fact --object')
+        if not re.match(r'^\d{4}-(0[1-9]|1[0-2])$', options.replace_period):
+            parser.error('--replace-period must be YYYY-MM')
+        if options.reprocess_quarantine:
+            parser.error('--replace-period cannot be used with --reprocess-quarantine')
+    configure_logging(options.log_level)
+    results = main(options.run_dimensions, options.run_facts, options.company_yaml, options.object_name,
+                   chunk_size=options.chunk_size, count_rows=options.count_rows, full_refresh=options.full_refresh,
+                   jobs=options.jobs, all_configs=options.all_configs, workers=options.workers,
+                   generate_datetime=options.generate_datetime, itersize=options.itersize,
+                   pipelined=options.pipelined, metrics_dir=options.metrics_dir, profile=options.profile,
+                   trace_rows=options.trace_rows if options.trace_rows == 'failed' else int(options.trace_rows),
+                   progress_interval=options.progress_interval, reprocess_quarantine=options.reprocess_quarantine,
+                   checkpoint_rows=options.checkpoint_rows, checkpoint_seconds=options.checkpoint_seconds,
+                   resume=options.resume, replace_period=options.replace_period,
+                   check_rollups=options.check_rollups, row_mode=options.row_mode)
+    # schedulers and cron see a failed object as a failed run
+    sys.exit(get_exit_status(results))
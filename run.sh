@@ -1,11 +1,2 @@
-python3 run.py --configs=ns3.yaml --run_dimensions
-python3 run.py --configs=ns3.yaml --run_facts
-python3 run.py --configs=btw.yaml --run_dimensions
-python3 run.py --configs=btw.yaml --run_facts
-python3 run.py --configs=dtwcns.yaml --run_dimensions
-python3 run.py --configs=dw.yaml --run_dimensions
-
-
-
-
-
+python3 run.py --configs=ns3.yaml,btw.yaml,dtwcns.yaml,dw.yaml --run_dimensions --workers=4
+python3 run.py --configs=ns3.yaml,btw.yaml --run_facts --workers=2
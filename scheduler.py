@@ -0,0 +1,107 @@
+import datetime
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from config import get_configs
+from etl import get_lookup_args, load_dimensions, run_dimension_object, run_fact_object
+from dw_object_folder.objects import GetObjects
+from reporting import configure_logging, get_log_level
+
+logger = logging.getLogger(__name__)
+
+
+# function to infer the dependencies of each object, facts depend on the dimensions of their keyrefs
+def build_graph(object_configs):
+    dimension_names = set(o['name'] for object_type, o in object_configs if object_type == 'dimension')
+    graph = {}
+    for object_type, o in object_configs:
+        deps = set()
+        if object_type == 'fact':
+            for keyref in o['fact_handler']['keyrefs']:
+                dim_name = get_lookup_args(keyref)
+                # dimensions that are not part of this run are treated as already loaded
+                if dim_name in dimension_names:
+                    deps.add(dim_name)
+        graph[o['name']] = (object_type, deps)
+    return graph
+
+
+# function run in a worker process, with its own source and dw connections
+def run_object_task(company_code, object_type, object_name, etl_options):
+    start = time.time()
+    result = {'name': object_name, 'type': object_type, 'company_code': company_code, 'status': 'done', 'rows': 0,
+              'error': ''}
+    src_pgconn, dw_pgconn = get_configs(company_code)
+    try:
+        o = GetObjects(company_code).get_object(object_type, object_name)
+        if object_type == 'dimension':
+            result['metrics'] = run_dimension_object(o, src_pgconn, dw_pgconn, etl_options)
+        else:
+            list_dimensions = load_dimensions(dw_pgconn)
+            result['metrics'] = run_fact_object(o, src_pgconn, dw_pgconn, list_dimensions, etl_options)
+        result['rows'] = result['metrics']['rows']
+    except Exception as e:
+        dw_pgconn.rollback()
+        logger.exception('{} failed'.format(object_name))
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(e.__class__.__name__, e)
+    finally:
+        src_pgconn.close()
+        dw_pgconn.close()
+    result['seconds'] = round(time.time() - start, 1)
+    return result
+
+
+# function to run objects on a process pool as soon as their dependencies are done
+def run_scheduled(company_code, object_configs, jobs, etl_options):
+    graph = build_graph(object_configs)
+    pending = dict(graph)
+    results = {}
+    running = {}
+    print('current time is {}'.format(datetime.datetime.now()))
+    # forked workers do not inherit the log listener thread, each one starts its own
+    with ProcessPoolExecutor(max_workers=jobs, initializer=configure_logging,
+                             initargs=(get_log_level(),)) as executor:
+        while pending or running:
+            changed = True
+            while changed:
+                changed = False
+                for name, (object_type, deps) in list(pending.items()):
+                    failed = [dep for dep in deps if dep in results and results[dep]['status'] != 'done']
+                    if failed:
+                        results[name] = {'name': name, 'type': object_type, 'company_code': company_code,
+                                         'status': 'skipped', 'rows': 0,
+                                         'seconds': 0, 'error': 'dependency failed: {}'.format(', '.join(failed))}
+                        del pending[name]
+                        changed = True
+                    elif all(dep in results for dep in deps):
+                        logger.info('schedule {}'.format(name))
+                        future = executor.submit(run_object_task, company_code, object_type, name, etl_options)
+                        running[future] = name
+                        del pending[name]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = {'name': name, 'type': graph[name][0], 'company_code': company_code,
+                                     'status': 'failed', 'rows': 0,
+                                     'seconds': 0, 'error': '{}: {}'.format(e.__class__.__name__, e)}
+                logger.info('{} {}'.format(name, results[name]['status']))
+
+    report = [results[name] for name in graph]
+    print_report(company_code, report)
+    return report
+
+
+# function to print the status of every object of a scheduled run
+def print_report(company_code, report):
+    print('')
+    print('run report of {}'.format(company_code))
+    for result in report:
+        print('{:<40} {:<10} {:<8} {:>10} rows {:>8}s {}'.format(result['name'], result['type'], result['status'],
+                                                                result['rows'], result['seconds'],
+                                                                result['error']))
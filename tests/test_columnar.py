@@ -0,0 +1,92 @@
+import datetime
+import os
+import time
+import pytest
+import columnar
+from parent_class import TransformBase
+
+pytest.importorskip('numpy')
+
+
+class DateTransform(TransformBase):
+    batch_steps = ('round_time', 'datetime_to_epoch', 'add_month_and_year')
+
+
+class DayTransform(TransformBase):
+    batch_steps = ('date_to_epoch',)
+
+
+class DimPartner(TransformBase):
+    company_code = 'ns3'
+    batch_steps = ('add_config_name',)
+
+
+# dates are converted in local time, the test runs in a zone with daylight saving time
+@pytest.fixture(autouse=True)
+def berlin_time():
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/Berlin'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+DATES = [
+    # pre-1970, with and without microseconds
+    datetime.datetime(1969, 12, 31, 23, 59, 59, 500000),
+    datetime.datetime(1965, 5, 1, 10, 7, 3, 250),
+    datetime.datetime(1950, 1, 1),
+    # around the spring and autumn transitions of 2021
+    datetime.datetime(2021, 3, 28, 1, 59, 30, 1),
+    datetime.datetime(2021, 3, 28, 3, 0, 0),
+    datetime.datetime(2021, 10, 31, 2, 30, 0, 999999),
+    datetime.datetime(2021, 10, 31, 3, 5, 0),
+    datetime.datetime(2024, 1, 1),
+]
+
+
+def test_batch_parity_on_datetimes():
+    rows = [{'date': date, 'period_name': None if number % 3 else '03/2021'} for number, date in enumerate(DATES)]
+    assert columnar.batch_parity(DateTransform(), rows) == []
+
+
+def test_batch_parity_on_dates():
+    rows = [{'date': date.date()} for date in DATES]
+    assert columnar.batch_parity(DayTransform(), rows) == []
+
+
+# the per-row helpers cannot take NULL dates, the batch path keeps them NULL around converted values
+def test_batch_keeps_nulls():
+    rows = [{'date': None, 'period_name': None}] + [{'date': date, 'period_name': '12/2020'} for date in DATES]
+    DateTransform().apply_batch(rows)
+    assert rows[0] == {'date': None, 'period_name': None, 'epoch': None, 'date_epoch': None, 'period_year': None,
+                       'period_month': None}
+    expected = [{'date': date, 'period_name': '12/2020'} for date in DATES]
+    for row in expected:
+        for step in DateTransform.batch_steps:
+            getattr(DateTransform(), step)(row)
+    assert rows[1:] == expected
+
+
+def test_batch_parity_on_lookup_keys():
+    rows = [{'initial_id': initial_id} for initial_id in (1, 'x\x00', 'x ', '', 'é')]
+    assert columnar.batch_parity(DimPartner(), rows) == []
+
+
+def test_batch_rejects_missing_company_code(monkeypatch):
+    monkeypatch.delenv('SRC_COMPANY_CODE', raising=False)
+    transform = DimPartner()
+    transform.company_code = None
+    with pytest.raises(TypeError):
+        transform.add_config_name({'initial_id': 1})
+    with pytest.raises(TypeError):
+        transform.apply_batch([{'initial_id': 1}])
+
+
+def test_batch_rejects_null_initial_id():
+    with pytest.raises(ValueError):
+        DimPartner().apply_batch([{'initial_id': 1}, {'initial_id': None}])
@@ -0,0 +1,195 @@
+import logging
+from control import lock_object, bump_dimension_version, ensure_quarantine_table, quarantine_rows
+from rows import as_dict
+from dimensions import remember_member
+
+logger = logging.getLogger(__name__)
+
+
+class RaiseMissingKeys:
+    """Fail the load on the first fact row with an unresolved keyref."""
+
+    def __init__(self, fact_name):
+        self.fact_name = fact_name
+        self.quarantined = 0
+        self.inferred = 0
+
+    # missing is a list of (keyref, dimension name) of the row
+    def handle(self, row, missing):
+        keyref, dim_name = missing[0]
+        logger.warning("{} was not present in the {}".format(keyref, dim_name))
+        raise ValueError("{} was not present in the {}".format(keyref, dim_name))
+
+    def flush(self):
+        pass
+
+    # called before each commit of the load
+    def commit(self):
+        pass
+
+    def finish(self):
+        pass
+
+    # called when the load fails, finish is not
+    def close(self):
+        pass
+
+
+class QuarantineMissingKeys(RaiseMissingKeys):
+    """Keep loading and store fact rows with unresolved keyrefs in the quarantine table.
+
+    Quarantined rows are written in the load transaction, so they are only
+    kept when the load is committed.
+    """
+
+    def __init__(self, fact_name, output_conn, company_code):
+        super().__init__(fact_name)
+        self.output_conn = output_conn
+        self.company_code = company_code
+        self.buffer = []
+        ensure_quarantine_table(output_conn)
+
+    def reason(self, missing):
+        return ', '.join('{} was not present in the {}'.format(keyref, dim_name) for keyref, dim_name in missing)
+
+    def handle(self, row, missing):
+        # rows are stored as json, compact rows are converted to dicts
+        self.buffer.append((self.reason(missing), as_dict(row)))
+        return False
+
+    def flush(self):
+        if not self.buffer:
+            return
+        quarantine_rows(self.output_conn, self.company_code, self.fact_name, self.buffer)
+        self.quarantined += len(self.buffer)
+        self.buffer = []
+
+    def finish(self):
+        self.flush()
+        if self.quarantined:
+            logger.warning('{}: {} rows quarantined'.format(self.fact_name, self.quarantined))
+
+
+class InferMissingKeys(QuarantineMissingKeys):
+    """Insert an inferred member for each unresolved lookup value.
+
+    The member only holds its key and lookup attributes, the other attributes
+    are filled in by the next run_dimension_etl (a set sync sees its NULL
+    row_hash as a change). Keys are assigned as MAX + 1 under the advisory lock
+    of the dimension, like the dimension loads do. Each member is inserted and
+    committed in a short transaction of its own, on a separate connection when
+    connect is given, so the fact load never holds dimension locks. Dimensions
+    whose keys are computed, or with attributes that are NOT NULL and have no
+    default, cannot be inferred, their rows are quarantined.
+    """
+
+    def __init__(self, fact_name, output_conn, company_code, dimensions, connect=None):
+        super().__init__(fact_name, output_conn, company_code)
+        self.dimensions = dimensions
+        self.connect = connect
+        self.infer_conn = None
+        # (dimension name, lookup values) -> key of the members inferred by this run
+        self.members = {}
+        # dimension name -> whether members can be inserted with only their key and lookup attributes
+        self.insertable = {}
+        self.inferred_dimensions = set()
+
+    def get_infer_conn(self):
+        if self.connect is None:
+            return self.output_conn
+        if self.infer_conn is None:
+            self.infer_conn = self.connect()
+        return self.infer_conn
+
+    # function to check that the attributes an inferred member leaves NULL accept it
+    def check_insertable(self, dimension):
+        if dimension.name not in self.insertable:
+            cursor = self.output_conn.cursor()
+            cursor.execute('''SELECT attname FROM pg_attribute
+                              WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+                              AND attnotnull AND NOT atthasdef AND attname <> ALL(%s)''',
+                           (dimension.name, [dimension.key] + list(dimension.lookupatts)))
+            required = [name for name, in cursor.fetchall()]
+            cursor.close()
+            if required:
+                logger.warning('{}: members of {} cannot be inferred, {} are NOT NULL without default'.format(
+                    self.fact_name, dimension.name, ', '.join(required)))
+            self.insertable[dimension.name] = not required
+        return self.insertable[dimension.name]
+
+    def infer(self, dimension, row):
+        values = tuple(row[att] for att in dimension.lookupatts)
+        if (dimension.name, values) in self.members:
+            return self.members[(dimension.name, values)]
+        if None in values or not self.check_insertable(dimension):
+            return None
+        conn = self.get_infer_conn()
+        lock_object(conn, dimension.name)
+        where = ' AND '.join('{} = %s'.format(att) for att in dimension.lookupatts)
+        cursor = conn.cursor()
+        # the member may have been inferred by an earlier run since the lookup cache was loaded
+        cursor.execute('SELECT {} FROM {} WHERE {}'.format(dimension.key, dimension.name, where), values)
+        result = cursor.fetchone()
+        if not result:
+            cursor.execute('''INSERT INTO {} ({}, {}) SELECT COALESCE(MAX({}), 0) + 1, {} FROM {}
+                              RETURNING {}'''.format(
+                dimension.name, dimension.key, ', '.join(dimension.lookupatts), dimension.key,
+                ', '.join(['%s'] * len(values)), dimension.name, dimension.key), values)
+            result = cursor.fetchone()
+            # fact runs reading a snapshot of the dimension must rebuild it
+            bump_dimension_version(conn, dimension.name)
+            self.inferred_dimensions.add(dimension.name)
+            self.inferred += 1
+            logger.info('{}: inferred member {} of {} for {}'.format(self.fact_name, result[0], dimension.name,
+                                                                   values))
+        cursor.close()
+        if conn is not self.output_conn:
+            # the lock is released at once, the member stays even if the fact load rolls back
+            conn.commit()
+        self.members[(dimension.name, values)] = result[0]
+        # the lookup cache of the dimension still holds None for the values
+        remember_member(dimension, row, result[0])
+        return result[0]
+
+    # keys of a computed dimension follow a grid, even when it fell back to lookups
+    def inferable(self, dim_name, dimension):
+        spec = getattr(self.dimensions, 'specs', {}).get(dim_name, {})
+        return not getattr(dimension, 'computed', False) and spec.get('lookup') != 'computed'
+
+    def handle(self, row, missing):
+        unresolved = []
+        for keyref, dim_name in missing:
+            dimension = self.dimensions[dim_name]
+            keyvalue = self.infer(dimension, row) if self.inferable(dim_name, dimension) else None
+            if keyvalue:
+                row[keyref] = keyvalue
+            else:
+                unresolved.append((keyref, dim_name))
+        if unresolved:
+            return super().handle(row, unresolved)
+        return True
+
+    def close(self):
+        if self.infer_conn is not None:
+            self.infer_conn.close()
+            self.infer_conn = None
+
+    def finish(self):
+        super().finish()
+        self.close()
+        if self.inferred:
+            logger.warning('{}: {} members inferred in {}'.format(self.fact_name, self.inferred,
+                                                                  ', '.join(sorted(self.inferred_dimensions))))
+
+
+# function to create the handler of unresolved keyrefs selected by the 'on_missing_key' key of the fact factory
+def create_missing_key_handler(pygram_fact_factory, output_conn, company_code, dimensions, connect=None):
+    policy = pygram_fact_factory.get('on_missing_key', 'raise')
+    fact_name = pygram_fact_factory['name']
+    if policy == 'raise':
+        return RaiseMissingKeys(fact_name)
+    if policy == 'quarantine':
+        return QuarantineMissingKeys(fact_name, output_conn, company_code)
+    if policy == 'infer':
+        return InferMissingKeys(fact_name, output_conn, company_code, dimensions, connect)
+    raise ValueError('unknown on_missing_key {} for {}'.format(policy, fact_name))